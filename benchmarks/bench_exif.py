@@ -0,0 +1,100 @@
+"""
+Compare the number of files per second for which the EXIF DateTimeOriginal
+can be read with Pillow (`Image.open(path)._getexif()`) and with the header
+only reader `metadata.read_datetime_original`.
+
+Usage:
+
+    python benchmarks/bench_exif.py [--images DIR] [--count N]
+
+`--images` is walked recursively, so it can point to a whole media root.
+Without it a set of synthetic JPEG images with a large EXIF block (a
+large maker note) is generated in a temporary directory. Run it
+twice on a network share to compare cold and warm caches.
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from metadata import read_datetime_original  # noqa: E402
+
+
+def read_pillow(filepath):
+    try:
+        dt = Image.open(filepath)._getexif()[36867]
+        return datetime.datetime.strptime(dt, "%Y:%m:%d %H:%M:%S")
+    except Exception:
+        return None
+
+
+METHODS = [
+    ("Pillow _getexif", read_pillow),
+    ("header only reader", read_datetime_original),
+]
+
+
+def make_images(path, count, size=(1920, 1080)):
+    image = Image.effect_noise(size, 64).convert("RGB")
+    for i in range(count):
+        exif = Image.Exif()
+        exif[0x010F] = "Camera maker"
+        exif[0x0110] = "Camera trap"
+        exif[36867] = f"2022:05:{1 + i % 28:02d} 12:{i % 60:02d}:00"
+        exif[0x927C] = os.urandom(32768)
+        image.save(os.path.join(path, f"IMG_{i:06d}.JPG"), quality=85, exif=exif)
+
+
+def find_images(path, count):
+    images = []
+    for root, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in (".jpg", ".jpeg"):
+                images.append(os.path.join(root, filename))
+                if count and len(images) >= count:
+                    return images
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", help="directory with sample JPEG images")
+    parser.add_argument(
+        "--count", type=int, help="the number of images (default: all or 2000)"
+    )
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = args.images
+        if not src:
+            src = tmpdir
+            make_images(src, args.count or 2000)
+        images = find_images(src, args.count)
+
+        print(f"{len(images)} images")
+        print(f"{'method':<24}{'files/s':>12}{'dated':>10}")
+        results = []
+        for name, func in METHODS:
+            start = time.perf_counter()
+            dates = [func(k) for k in images]
+            elapsed = time.perf_counter() - start
+            results.append(dates)
+            dated = sum(k is not None for k in dates)
+            print(f"{name:<24}{len(images) / elapsed:>12.0f}{dated:>10}")
+        mismatches = sum(a != b for a, b in zip(*results))
+        print(f"mismatches: {mismatches}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Encode a sample clip with every encoding profile and report the encoding
+speed (frames per second), the output size and the wall time. It helps to
+choose the fastest profile accepted by your TRAPPER server for your
+hardware.
+
+Usage:
+
+    python benchmarks/bench_profiles.py [--video PATH] [--duration SECONDS]
+        [--ffmpeg PATH] [--workers N] [--profiles PATH]
+
+Without `--video` a synthetic clip is generated with ffmpeg.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from convert import (  # noqa: E402
+    ENCODING_PROFILES_PATH,
+    MediaConverter,
+    load_encoding_profiles,
+)
+
+
+def make_video(ffmpeg, path, duration):
+    subprocess.run(
+        [
+            ffmpeg,
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=duration={duration}:size=1280x720:rate=25",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=duration={duration}",
+            "-c:v",
+            "mpeg4",
+            "-q:v",
+            "3",
+            "-c:a",
+            "pcm_s16le",
+            path,
+        ],
+        check=True,
+    )
+
+
+def encode(converter, video, args, outfile):
+    cmd = converter.get_ffmpeg_cmd([(args, outfile)])
+    start = time.perf_counter()
+    p = converter.start_ffmpeg(video, cmd)
+    if p.wait() != 0:
+        raise Exception(p.error)
+    elapsed = time.perf_counter() - start
+    frames = int(p.stats.get("frame", 0))
+    return frames / elapsed, os.path.getsize(outfile), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--video", help="a sample video")
+    parser.add_argument("--duration", type=int, default=60)
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--profiles", default=ENCODING_PROFILES_PATH)
+    args = parser.parse_args()
+
+    profiles = load_encoding_profiles(args.profiles)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        video = args.video
+        if not video:
+            video = os.path.join(tmpdir, "clip.avi")
+            make_video(args.ffmpeg, video, args.duration)
+        converter = MediaConverter(
+            media_root=os.path.dirname(os.path.abspath(video)),
+            output_path=tmpdir,
+            ffmpeg=args.ffmpeg,
+            src_ext_images=[],
+            src_ext_videos=[os.path.splitext(video)[1].lower()],
+            profiles=profiles,
+            # a single job gets all the threads
+            workers=args.workers,
+            ffmpeg_jobs=1,
+        )
+
+        print(
+            f"{'profile':<16}{'format':<8}{'fps':>10}{'size [MB]':>12}{'time [s]':>10}"
+        )
+        for name, profile in profiles.items():
+            for ext, ext_args in profile.items():
+                outfile = os.path.join(tmpdir, f"{name}.{ext}")
+                fps, size, elapsed = encode(converter, video, ext_args, outfile)
+                print(
+                    f"{name:<16}{ext:<8}{fps:>10.1f}"
+                    f"{size / 1024 / 1024:>12.2f}{elapsed:>10.1f}"
+                )
+        converter.manifest.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
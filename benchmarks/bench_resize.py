@@ -0,0 +1,102 @@
+"""
+Compare the time and peak memory needed to resize camera trap images with
+a full resolution decode and with the decoder side (DCT scaling) reduction
+used by `convert.resize_image`.
+
+Usage:
+
+    python benchmarks/bench_resize.py [--images DIR] [--count N] [--size WxH]
+
+Without `--images` a set of synthetic 24 MP JPEG images is generated in
+a temporary directory. Each method runs in a fresh process so its peak
+memory (Unix only) is not affected by the other methods.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from convert import resize_image  # noqa: E402
+
+METHODS = [
+    ("full decode", None),
+    ("draft, reducing_gap=3.0", 3.0),
+    ("draft, reducing_gap=2.0 (default)", 2.0),
+    ("draft, reducing_gap=1.0", 1.0),
+]
+
+
+def make_images(path, count, size=(6000, 4000)):
+    exif = Image.Exif()
+    exif[36867] = "2022:05:01 12:00:00"
+    noise = Image.effect_noise(size, 64).convert("RGB")
+    for i in range(count):
+        noise.save(os.path.join(path, f"IMG_{i:04d}.JPG"), quality=90, exif=exif)
+
+
+def run_method(images, outdir, size, reducing_gap):
+    start = time.perf_counter()
+    for image in images:
+        resize_image(
+            image, os.path.join(outdir, os.path.basename(image)), size, reducing_gap
+        )
+    elapsed = time.perf_counter() - start
+    if resource is None:
+        return elapsed, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        maxrss = maxrss / 1024
+    return elapsed, maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", help="directory with sample JPEG images")
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--size", default="800x600")
+    args = parser.parse_args()
+    size = tuple(int(k) for k in args.size.split("x"))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = args.images
+        if not src:
+            src = os.path.join(tmpdir, "src")
+            os.makedirs(src)
+            make_images(src, args.count)
+        images = sorted(
+            os.path.join(src, k)
+            for k in os.listdir(src)
+            if os.path.splitext(k)[1].lower() in (".jpg", ".jpeg")
+        )[: args.count]
+        outdir = os.path.join(tmpdir, "out")
+        os.makedirs(outdir)
+
+        print(f"{len(images)} images resized to {args.size}")
+        print(f"{'method':<36}{'ms/image':>10}{'peak RSS [MB]':>16}")
+        for name, reducing_gap in METHODS:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                elapsed, maxrss = executor.submit(
+                    run_method, images, outdir, size, reducing_gap
+                ).result()
+            maxrss = "n/a" if maxrss is None else f"{maxrss:.1f}"
+            print(f"{name:<36}{elapsed / len(images) * 1000:>10.1f}{maxrss:>16}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
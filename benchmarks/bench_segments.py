@@ -0,0 +1,111 @@
+"""
+Compare the wall time of converting a long video with a single ffmpeg
+process and with the segmented conversion (split at keyframes, segments
+encoded in parallel, concatenated losslessly).
+
+Usage:
+
+    python benchmarks/bench_segments.py [--video PATH] [--duration SECONDS]
+        [--ffmpeg PATH] [--workers N] [--webm]
+
+Without `--video` a synthetic clip is generated with ffmpeg. The segmented
+conversion needs `ffprobe` next to the `ffmpeg` binary.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from convert import MediaConverter  # noqa: E402
+
+
+def make_video(ffmpeg, path, duration):
+    subprocess.run(
+        [
+            ffmpeg,
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=duration={duration}:size=1280x720:rate=25",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=duration={duration}",
+            "-c:v",
+            "mpeg4",
+            "-q:v",
+            "3",
+            "-g",
+            "250",
+            "-c:a",
+            "pcm_s16le",
+            path,
+        ],
+        check=True,
+    )
+
+
+def convert(media_root, output_path, args, segment_min_duration, ffmpeg_jobs=None):
+    converter = MediaConverter(
+        media_root=media_root,
+        output_path=output_path,
+        ffmpeg=args.ffmpeg,
+        convert2mp4=True,
+        convert2webm=args.webm,
+        src_ext_images=[],
+        src_ext_videos=[os.path.splitext(args.video or "x.avi")[1].lower()],
+        passthrough=False,
+        overwrite=True,
+        workers=args.workers,
+        ffmpeg_jobs=ffmpeg_jobs,
+        segment_min_duration=segment_min_duration,
+    )
+    start = time.perf_counter()
+    converter.handle()
+    elapsed = time.perf_counter() - start
+    if converter.errors:
+        raise Exception(converter.errors[0][1])
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--video", help="a long sample video")
+    parser.add_argument("--duration", type=int, default=600)
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--webm", action="store_true", help="convert to webm too")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        media_root = os.path.join(tmpdir, "media", "collection", "deployment")
+        os.makedirs(media_root)
+        if args.video:
+            shutil.copy2(args.video, media_root)
+        else:
+            make_video(args.ffmpeg, os.path.join(media_root, "clip.avi"), args.duration)
+        media_root = os.path.join(tmpdir, "media")
+        output_path = os.path.join(tmpdir, "output")
+        os.makedirs(output_path)
+
+        # a single job gets all the threads
+        single = convert(media_root, output_path, args, None, ffmpeg_jobs=1)
+        segmented = convert(media_root, output_path, args, 1)
+        print(f"workers: {args.workers}")
+        print(f"single process: {single:8.1f} s")
+        print(f"segmented:      {segmented:8.1f} s ({single / segmented:.2f}x)")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
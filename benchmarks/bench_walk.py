@@ -0,0 +1,98 @@
+"""
+Compare the time needed to index a media root with the sequential walk and
+with the parallel directory listing of `media_index.MediaIndex` on a
+simulated high latency filesystem (e.g. a SMB/NFS share).
+
+Usage:
+
+    python benchmarks/bench_walk.py [--root DIR] [--latency MS]
+        [--collections N] [--deployments N] [--files N]
+        [--workers N [N ...]]
+
+Without `--root` a synthetic tree of empty media files is generated in a
+temporary directory. The latency is added to each directory listing by
+a shim around `os.scandir`; use `--latency 0` with `--root` pointing to
+a real network share to measure it without the shim.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import media_index  # noqa: E402
+
+IMAGE_EXT = [".jpg"]
+VIDEO_EXT = [".mp4"]
+
+
+def make_tree(root, collections, deployments, files):
+    for c in range(collections):
+        for d in range(deployments):
+            path = os.path.join(root, f"collection_{c}", f"deployment-{d:04d}")
+            os.makedirs(path)
+            for f in range(files):
+                ext = VIDEO_EXT[0] if f % 10 == 0 else IMAGE_EXT[0]
+                open(os.path.join(path, f"IMG_{f:05d}{ext}"), "w").close()
+
+
+def add_latency(latency):
+    scandir = os.scandir
+
+    def slow_scandir(path="."):
+        time.sleep(latency)
+        return scandir(path)
+
+    os.scandir = slow_scandir
+
+
+def index_tree(root, workers):
+    start = time.perf_counter()
+    index = media_index.MediaIndex(root, IMAGE_EXT, VIDEO_EXT, workers=workers)
+    elapsed = time.perf_counter() - start
+    listing = [
+        (relpath, media_dir.dirs, [k.name for k in media_dir.files])
+        for relpath, media_dir in index.iter_dirs()
+    ]
+    return elapsed, listing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", help="a media root to index")
+    parser.add_argument("--latency", type=float, default=5.0, help="in ms")
+    parser.add_argument("--collections", type=int, default=4)
+    parser.add_argument("--deployments", type=int, default=50)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16, 32])
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        root = args.root
+        if not root:
+            root = tmpdir
+            make_tree(root, args.collections, args.deployments, args.files)
+        if args.latency:
+            add_latency(args.latency / 1000)
+
+        print(f"latency per directory listing: {args.latency} ms")
+        print(f"{'workers':>8}{'time [s]':>12}{'speedup':>10}  same order")
+        baseline = None
+        for workers in args.workers:
+            elapsed, listing = index_tree(root, workers)
+            if baseline is None:
+                baseline = elapsed, listing
+            print(
+                f"{workers:>8}{elapsed:>12.2f}{baseline[0] / elapsed:>10.2f}"
+                f"  {listing == baseline[1]}"
+            )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
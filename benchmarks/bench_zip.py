@@ -0,0 +1,141 @@
+"""
+Compare the time needed to build a package zip archive (with the SHA-256
+manifest) when the files are read and written one after another and with
+the read-ahead pipeline of `package.DataPackageGenerator.make_zip`.
+
+Usage:
+
+    python benchmarks/bench_zip.py [--src DIR] [--dst DIR]
+        [--deployments N] [--files N] [--size MB] [--repeat N]
+
+A synthetic media root (`collection/deployment/files`) is generated in
+`--src` and the zip archives are written to `--dst`. Point them to two
+directories on different devices (e.g. an SD card or a USB disk and the
+internal disk) to measure the overlap of the reads and the writes; by
+default both are temporary directories. On Linux the source files are
+dropped from the page cache before each run, elsewhere the later runs
+can read them from the memory.
+"""
+
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import package  # noqa: E402
+
+COLLECTION = "collection"
+
+
+def make_tree(root, deployments, files, size):
+    data = os.urandom(size)
+    for d in range(deployments):
+        path = os.path.join(root, COLLECTION, f"deployment-{d:04d}")
+        os.makedirs(path)
+        for f in range(files):
+            ext = ".mp4" if f % 10 == 0 else ".jpg"
+            with open(os.path.join(path, f"IMG_{f:05d}{ext}"), "wb") as _file:
+                # make every file unique so the hashes differ
+                _file.write(f"{d}-{f}".encode() + data)
+
+
+def drop_cache(files):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for filepath in files:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def sequential_zip(zip_path, files, data_path, manifest_path):
+    # read, hash and write each file in turn in the same thread
+    with zipfile.ZipFile(zip_path, "w", allowZip64=True) as _zipfile, open(
+        manifest_path, "w", newline=""
+    ) as _manifest:
+        manifest = csv.writer(_manifest)
+        manifest.writerow(package.MANIFEST_FIELDS)
+        for _file in files:
+            f_archive = os.path.relpath(_file, data_path)
+            stat = os.stat(_file)
+            zinfo = zipfile.ZipInfo.from_file(_file, f_archive)
+            sha256 = hashlib.sha256()
+            with open(_file, "rb") as src, _zipfile.open(zinfo, "w") as dest:
+                while True:
+                    chunk = src.read(package.ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    dest.write(chunk)
+            manifest.writerow(
+                [f_archive, stat.st_size, stat.st_mtime_ns, sha256.hexdigest()]
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--src", help="a directory for the synthetic media root")
+    parser.add_argument("--dst", help="a directory for the zip archives")
+    parser.add_argument("--deployments", type=int, default=4)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--size", type=float, default=2.0, help="MB per file")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    src = tempfile.mkdtemp(dir=args.src)
+    dst = tempfile.mkdtemp(dir=args.dst)
+    try:
+        make_tree(src, args.deployments, args.files, int(args.size * 1024**2))
+        generator = package.DataPackageGenerator(
+            src,
+            dst,
+            [COLLECTION],
+            "bench",
+            "UTC",
+            image_ext=[".jpg"],
+            video_ext=[".mp4"],
+            project="bench",
+        )
+        generator.logger = logging.getLogger("bench_zip")
+        files = list(generator.yaml_generator.files)
+        total = generator.yaml_generator.get_size() / 1024**2
+
+        def pipeline_zip(zip_path, files, data_path, manifest_path):
+            generator.make_zip(zip_path, files, None, manifest_path)
+
+        methods = [("sequential", sequential_zip), ("read-ahead", pipeline_zip)]
+        print(f"{len(files)} files, {total:.0f} MB")
+        print(f"{'method':<16}{'time [s]':>12}{'MB/s':>10}")
+        manifests = {}
+        for name, func in methods:
+            zip_path = os.path.join(dst, f"{name}.zip")
+            manifest_path = os.path.join(dst, f"{name}.csv")
+            elapsed = []
+            for i in range(args.repeat):
+                drop_cache(files)
+                start = time.perf_counter()
+                func(zip_path, files, src, manifest_path)
+                elapsed.append(time.perf_counter() - start)
+                os.remove(zip_path)
+            with open(manifest_path) as _manifest:
+                manifests[name] = _manifest.read()
+            best = min(elapsed)
+            print(f"{name:<16}{best:>12.2f}{total / best:>10.1f}")
+        print(f"same manifest: {len(set(manifests.values())) == 1}")
+    finally:
+        shutil.rmtree(src)
+        shutil.rmtree(dst)
+
+
+if __name__ == "__main__":
+    main()
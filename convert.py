@@ -1,15 +1,515 @@
 import os
 import datetime
+import errno
+import json
 import platform
 import shutil
+import struct
 import subprocess
+import sys
+import tempfile
+import time
+from collections import deque, namedtuple
+from contextlib import closing
+from threading import Thread
 from PIL import Image
 
+from media_index import TMP_PREFIX, MediaIndex
+from utils import SQLiteStore, run_ordered
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# the Linux ioctl which shares the data blocks of two files (reflink)
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+COPY_STRATEGIES = ("hardlink", "reflink", "copy_file_range", "buffer")
+
+
+def update_mdt(file_path_orig, file_path_conv):
+    mdt_original = datetime.datetime.utcfromtimestamp(os.path.getmtime(file_path_orig))
+    timestamp = (mdt_original - datetime.datetime(1970, 1, 1)).total_seconds()
+    os.utime(file_path_conv, (timestamp, timestamp))
+
+
+def is_faststart(filepath):
+    """
+    Check if the "moov" box of an MP4 file comes before its "mdat" box,
+    i.e. if the file can be played before it is fully downloaded.
+    """
+    with open(filepath, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box_type = struct.unpack(">I4s", header)
+            if box_type == b"moov":
+                return True
+            if box_type == b"mdat" or size == 0:
+                return False
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0] - 8
+            f.seek(size - 8, os.SEEK_CUR)
+
+
+def get_tmp_path(filepath):
+    """
+    Get a temporary path for an output file. The extension is kept as
+    both Pillow and ffmpeg choose the output format based on it.
+    """
+    dirname, basename = os.path.split(filepath)
+    return os.path.join(dirname, TMP_PREFIX + basename).replace("\\", "/")
+
+
+def remove_file(filepath):
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def prepare_tmp_path(outfile):
+    """
+    Get the temporary path of an output file and remove a stale file
+    left there, which may be a hardlink to a source file that would be
+    overwritten through it.
+    """
+    tmpfile = get_tmp_path(outfile)
+    remove_file(tmpfile)
+    return tmpfile
+
+
+def replace_file(tmpfile, outfile):
+    os.replace(tmpfile, outfile)
+    # renaming a hardlink over another link to the same file is a no-op
+    remove_file(tmpfile)
+
+
+def copy_hardlink(src, dst):
+    os.link(src, dst)
+
+
+def copy_reflink(src, dst):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_file_range(src, dst):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.EOPNOTSUPP, "copy_file_range is not supported")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                # e.g. the file was truncated meanwhile or the filesystem
+                # does not support it; a short copy must not pass as done
+                raise OSError(errno.EIO, "copy_file_range stopped early", src)
+            remaining -= copied
+
+
+def copy_buffer(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+
+
+COPY_FUNCTIONS = {
+    "hardlink": copy_hardlink,
+    "reflink": copy_reflink,
+    "copy_file_range": copy_file_range,
+    "buffer": copy_buffer,
+}
+
+
+def copy_file(src, dst, strategies=COPY_STRATEGIES):
+    """
+    Copy a file with the first of the `strategies` which works for it:
+
+    * "hardlink" - link the file if both paths are on the same filesystem,
+    * "reflink" - share the data blocks on copy-on-write filesystems,
+    * "copy_file_range" - copy the data inside the kernel,
+    * "buffer" - copy the data through a large user space buffer.
+
+    As with `shutil.copy2` the file metadata is copied too. It returns
+    the name of the strategy used.
+    """
+    # never write through a stale link to another file
+    remove_file(dst)
+    for strategy in strategies[:-1]:
+        try:
+            COPY_FUNCTIONS[strategy](src, dst)
+        except OSError:
+            remove_file(dst)
+            continue
+        break
+    else:
+        strategy = strategies[-1]
+        COPY_FUNCTIONS[strategy](src, dst)
+    if strategy != "hardlink":
+        shutil.copystat(src, dst)
+    return strategy
+
+
+def copy_output(src, outfile, strategies=COPY_STRATEGIES):
+    """
+    Copy a source file to an output file (see `copy_file`) through
+    a temporary file, so an interrupted copy never leaves a partial output
+    behind. The output keeps the timestamps of the source, a hardlink
+    shares them and `copy_file` copies them otherwise. It returns the name
+    of the strategy used.
+    """
+    tmpfile = get_tmp_path(outfile)
+    try:
+        strategy = copy_file(src, tmpfile, strategies)
+        replace_file(tmpfile, outfile)
+    except BaseException:
+        remove_file(tmpfile)
+        raise
+    return strategy
+
+
+def resize_image(image, outfile, size, reducing_gap=2.0):
+    """
+    Resize an image to fit in `size` and save it with its original EXIF
+    data (if there is any). The image is first downscaled by an integer
+    factor, for JPEG images by the decoder itself (DCT scaling, see
+    `Image.draft`), as long as it stays at least `reducing_gap` times bigger
+    than `size`. Only the remaining step is done with the high quality
+    filter. With `reducing_gap=None` the full resolution image is decoded.
+    """
+    with Image.open(image) as img:
+        img.thumbnail(size, Image.ANTIALIAS, reducing_gap=reducing_gap)
+        kwargs = {}
+        if "exif" in img.info:
+            kwargs["exif"] = img.info["exif"]
+        img.save(outfile, **kwargs)
+
+
+def convert_image(
+    image,
+    outfile,
+    resize_img_size=None,
+    keep_mdt=True,
+    reducing_gap=2.0,
+    copy_strategies=COPY_STRATEGIES,
+):
+    """
+    Resize (or just copy) a single image. It is executed in a thread pool;
+    Pillow releases the GIL while it decodes, resizes and encodes images.
+    The image is written to a temporary file first and then renamed, so an
+    interrupted conversion never leaves a partial output behind.
+    """
+    if not resize_img_size:
+        copy_output(image, outfile, copy_strategies)
+        return outfile
+    tmpfile = prepare_tmp_path(outfile)
+    try:
+        resize_image(image, tmpfile, resize_img_size, reducing_gap)
+        if keep_mdt:
+            update_mdt(image, tmpfile)
+        replace_file(tmpfile, outfile)
+    except BaseException:
+        remove_file(tmpfile)
+        raise
+    return outfile
+
+
+# an ffmpeg command converting `video`; `source` is the file fed to its stdin
+# and `outfiles` (with their manifest `settings`) are the final output files
+# it makes; intermediate steps of a segmented conversion make none of them
+FFmpegJob = namedtuple(
+    "FFmpegJob",
+    ["video", "source", "outfiles", "settings", "cmd", "conversion"],
+    defaults=[None],
+)
+
+
+class FFmpegProcess:
+    """
+    A running ffmpeg job started with `-progress pipe:1`. Its progress
+    reports and error messages are read by background threads, so many
+    jobs can run at once without blocking on full pipes.
+    """
+
+    STDERR_LINES = 50
+
+    def __init__(self, cmd, **kwargs):
+        self.process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
+        )
+        # the last complete progress report, e.g. "frame", "fps",
+        # "out_time" and "speed"
+        self.stats = {}
+        self.stderr = deque(maxlen=self.STDERR_LINES)
+        self.threads = [
+            Thread(target=self.read_progress, daemon=True),
+            Thread(target=self.read_stderr, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def read_progress(self):
+        stats = {}
+        for line in self.process.stdout:
+            key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+            stats[key] = value
+            # each report ends with "progress=continue" or "progress=end"
+            if key == "progress":
+                self.stats = stats
+                stats = {}
+
+    def read_stderr(self):
+        for line in self.process.stderr:
+            self.stderr.append(line.decode("utf-8", "replace").rstrip())
+
+    def poll(self):
+        return self.process.poll()
+
+    def wait(self):
+        returncode = self.process.wait()
+        for thread in self.threads:
+            thread.join()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        return returncode
+
+    def kill(self):
+        self.process.kill()
+        return self.wait()
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    @property
+    def error(self):
+        return "\n".join(self.stderr)
+
+
+class SegmentedConversion:
+    """
+    The conversion of a long video which is split at keyframes into segments.
+    The segments (without audio) and the whole audio track are encoded by
+    parallel ffmpeg jobs and then losslessly concatenated into the outputs.
+    The conversion is driven by `step` which returns the jobs of its next
+    stage: "split" -> "encode" -> "concat".
+    """
+
+    def __init__(self, converter, video, outputs, duration, has_audio):
+        self.converter = converter
+        self.video = video
+        # a list of (args, outfile, settings) tuples
+        self.outputs = outputs
+        self.has_audio = has_audio
+        self.segment_time = max(
+            duration / converter.ffmpeg_jobs, converter.SEGMENT_MIN_LENGTH
+        )
+        self.tmpdir = tempfile.mkdtemp(
+            prefix=TMP_PREFIX, dir=os.path.dirname(outputs[0][1])
+        )
+        self.stage = "split"
+        self.pending = 0
+        self.error = None
+
+    @property
+    def outfiles(self):
+        return [k[1] for k in self.outputs]
+
+    @property
+    def settings(self):
+        return [k[2] for k in self.outputs]
+
+    def get_job(self, source, cmd, outfiles=(), settings=()):
+        self.pending += 1
+        return FFmpegJob(self.video, source, list(outfiles), list(settings), cmd, self)
+
+    def get_part_path(self, k, name):
+        ext = os.path.splitext(self.outputs[k][1])[1]
+        return os.path.join(self.tmpdir, f"out{k}-{name}{ext}")
+
+    def get_split_job(self):
+        args = [
+            "-map",
+            "0:v:0",
+            "-c",
+            "copy",
+            "-f",
+            "segment",
+            "-segment_time",
+            f"{self.segment_time:.3f}",
+            "-reset_timestamps",
+            "1",
+        ]
+        path = os.path.join(self.tmpdir, "src%05d.mkv")
+        return self.get_job(self.video, self.converter.get_ffmpeg_cmd([(args, path)]))
+
+    def get_encode_jobs(self):
+        jobs = []
+        segments = sorted(k for k in os.listdir(self.tmpdir) if k.startswith("src"))
+        for segment in segments:
+            name = os.path.splitext(segment)[0][3:]
+            outputs = [
+                (args + ["-an"], self.get_part_path(k, name))
+                for k, (args, outfile, settings) in enumerate(self.outputs)
+            ]
+            source = os.path.join(self.tmpdir, segment)
+            jobs.append(self.get_job(source, self.converter.get_ffmpeg_cmd(outputs)))
+        if segments and self.has_audio:
+            outputs = [
+                (args + ["-vn"], self.get_part_path(k, "audio"))
+                for k, (args, outfile, settings) in enumerate(self.outputs)
+            ]
+            jobs.append(
+                self.get_job(self.video, self.converter.get_ffmpeg_cmd(outputs))
+            )
+        return jobs
+
+    def get_concat_jobs(self):
+        jobs = []
+        for k, (args, outfile, settings) in enumerate(self.outputs):
+            audio = self.get_part_path(k, "audio")
+            parts = sorted(
+                name
+                for name in os.listdir(self.tmpdir)
+                if name.startswith(f"out{k}-") and name != os.path.basename(audio)
+            )
+            list_path = os.path.join(self.tmpdir, f"out{k}.txt")
+            with open(list_path, "w") as _list:
+                for name in parts:
+                    _list.write(f"file '{name}'\n")
+            input_args = ["-f", "concat", "-safe", "0", "-i", list_path]
+            out_args = ["-map", "0:v", "-c", "copy"]
+            if self.has_audio:
+                input_args.extend(["-i", audio])
+                out_args.extend(["-map", "1:a"])
+            if outfile.endswith(".mp4"):
+                out_args.extend(["-movflags", "faststart"])
+            cmd = self.converter.get_ffmpeg_cmd(
+                [(out_args, get_tmp_path(outfile))], input_args
+            )
+            jobs.append(self.get_job(None, cmd, [outfile], [settings]))
+        return jobs
+
+    def step(self, job, p):
+        """
+        Register a finished job of this conversion. When all jobs of the
+        current stage succeeded it returns the jobs of the next stage.
+        """
+        self.pending -= 1
+        if p.returncode != 0 and self.error is None:
+            self.error = p.error or f"ffmpeg exited with code {p.returncode}"
+        if self.pending or self.error is not None:
+            return []
+        if self.stage == "split":
+            self.stage = "encode"
+            jobs = self.get_encode_jobs()
+            if not jobs:
+                self.error = "The video could not be split into segments."
+            return jobs
+        if self.stage == "encode":
+            self.stage = "concat"
+            return self.get_concat_jobs()
+        return []
+
+    def cleanup(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class ConversionManifest(SQLiteStore):
+    """
+    The SQLite database in the output directory which remembers from which
+    source file (its size and modification time) and with which settings
+    each output file was made. It lets a conversion redo only stale or
+    missing outputs. A new output only adds a row, so the cost does not grow
+    with the number of outputs already recorded.
+    """
+
+    FILENAME = ".trapper_convert.sqlite3"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS outputs ("
+        "outfile TEXT PRIMARY KEY, source TEXT, size INTEGER, "
+        "mtime INTEGER, settings TEXT)"
+    )
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        super().__init__(os.path.join(output_path, self.FILENAME))
+
+    def get_key(self, outfile):
+        return os.path.relpath(outfile, self.output_path).replace("\\", "/")
+
+    def get_entry(self, source, settings):
+        stat = os.stat(source)
+        return (
+            os.path.abspath(source).replace("\\", "/"),
+            stat.st_size,
+            stat.st_mtime_ns,
+            json.dumps(settings, sort_keys=True),
+        )
+
+    def is_current(self, source, outfile, settings):
+        row = self.fetchone(
+            "SELECT source, size, mtime, settings FROM outputs WHERE outfile = ?",
+            (self.get_key(outfile),),
+        )
+        return row == self.get_entry(source, settings) and os.path.isfile(outfile)
+
+    def add(self, source, outfile, settings):
+        self.write(
+            "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)",
+            (self.get_key(outfile),) + self.get_entry(source, settings),
+        )
+
+
+ENCODING_PROFILES_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "encoding_profiles.json"
+)
+
+
+def load_encoding_profiles(path=ENCODING_PROFILES_PATH):
+    """
+    Load the named encoding profiles, i.e. the ffmpeg output args used for
+    the "mp4" and "webm" conversions. Note that "-preset" (libx264) and
+    "-cpu-used" (libvpx) are the critical parameters related to the speed
+    of conversion.
+    """
+    with open(path, "r") as _profiles:
+        return json.load(_profiles)
+
 
 class MediaConverter:
     """ """
 
     DEFAULT_RESIZE_IMG_SIZE = (800, 600)
+    DEFAULT_RESIZE_REDUCING_GAP = 2.0
+    DEFAULT_PROFILE = "balanced"
+    FFMPEG_THREADS_PER_JOB = 2
+    FFMPEG_POLL_INTERVAL = 0.1
+    FFMPEG_STATS_INTERVAL = 1.0
+    SEGMENT_MIN_LENGTH = 30
+    # streams that can be used in the output files without re-encoding
+    # (as long as their bitrate is not higher than in the encoding profile)
+    TARGET_PROFILES = {
+        "mp4": {
+            "vcodec": ["h264"],
+            "pix_fmt": ["yuv420p"],
+            "acodec": ["aac"],
+        },
+        "webm": {
+            "vcodec": ["vp8"],
+            "pix_fmt": ["yuv420p"],
+            "acodec": ["vorbis"],
+        },
+    }
+    REMUX_ARGS = {
+        "mp4": ["-c", "copy", "-movflags", "faststart"],
+        "webm": ["-c", "copy"],
+    }
 
     def __init__(
         self,
@@ -19,12 +519,23 @@ class MediaConverter:
         keep_mdt=True,
         resize_img=False,
         resize_img_size=None,
+        resize_reducing_gap=DEFAULT_RESIZE_REDUCING_GAP,
         convert2mp4=True,
         convert2webm=False,
+        profile=DEFAULT_PROFILE,
+        profiles=None,
+        single_decode=True,
+        passthrough=True,
         src_ext_images=None,
         src_ext_videos=None,
         overwrite=False,
         callback=None,
+        stats_callback=None,
+        workers=None,
+        ffmpeg_jobs=None,
+        segment_min_duration=None,
+        copy_strategies=COPY_STRATEGIES,
+        walk_workers=1,
     ):
         if not media_root or not output_path:
             raise Exception('You have to choose both "Media root" and "Output path".')
@@ -39,6 +550,18 @@ class MediaConverter:
         self.FFMPEG = ffmpeg
         self.keep_mdt = keep_mdt
         self.callback = callback
+        self.stats_callback = stats_callback
+        self.copy_strategies = copy_strategies
+        self.workers = max(int(workers or os.cpu_count() or 1), 1)
+        # split the available workers between concurrent ffmpeg jobs so
+        # the machine is not oversubscribed (see `get_ffmpeg_threads`)
+        self.ffmpeg_jobs = max(
+            int(ffmpeg_jobs or self.workers // self.FFMPEG_THREADS_PER_JOB), 1
+        )
+        self.ffmpeg_threads = max(self.workers // self.ffmpeg_jobs, 1)
+        # videos at least this long (in seconds) are split into segments
+        # encoded in parallel; None disables the segmented conversion
+        self.segment_min_duration = segment_min_duration
         if (src_ext_images is None or len(src_ext_images) == 0) and (
             src_ext_videos is None or len(src_ext_videos) == 0
         ):
@@ -51,12 +574,30 @@ class MediaConverter:
         self.resize_img_size = resize_img_size
         if self.resize_img and self.resize_img_size is None:
             self.resize_img_size = self.DEFAULT_RESIZE_IMG_SIZE
+        self.resize_reducing_gap = resize_reducing_gap
         self.convert2mp4 = convert2mp4
         self.convert2webm = convert2webm
+        self.profiles = profiles if profiles is not None else load_encoding_profiles()
+        if profile not in self.profiles:
+            raise Exception("There is no encoding profile: %s" % profile)
+        self.profile = profile
+        self.single_decode = single_decode
+        self.passthrough = passthrough
+        # a list of (video, outfile, action) tuples where action is one
+        # of "transcode", "remux" or "copy"
+        self.plan = []
+        # a list of (video, error message) tuples of failed ffmpeg jobs
+        self.errors = []
 
         # get matches
-        self.matches_images = self.get_matches(self.src_ext_images)
-        self.matches_videos = self.get_matches(self.src_ext_videos)
+        self.media_index = MediaIndex(
+            self.media_root,
+            self.src_ext_images,
+            self.src_ext_videos,
+            workers=walk_workers,
+        )
+        self.matches_images = self.get_matches("image")
+        self.matches_videos = self.get_matches("video")
         self.nfiles = len(self.matches_images) + len(self.matches_videos)
 
         if self.nfiles == 0:
@@ -66,28 +607,21 @@ class MediaConverter:
                     "and selected image and video extensions."
                 )
             )
+        self.manifest = ConversionManifest(self.output_path)
 
     def replace_ext(self, filepath, ext):
         ext = ext.split(".")[-1]
         base = os.path.splitext(filepath)[0]
         return ".".join([base, ext])
 
-    def filter_files(self, filenames, src_ext):
-        return [k for k in filenames if os.path.splitext(k)[1].lower() in [*src_ext]]
-
-    def get_matches(self, src_ext):
-        matches = []
-        for root, dirnames, filenames in os.walk(self.media_root):
-            for filename in self.filter_files(filenames, src_ext):
-                matches.append(os.path.join(root, filename).replace("\\", "/"))
-        return matches
+    def get_matches(self, file_type):
+        return [
+            k.path.replace("\\", "/")
+            for k in self.media_index.iter_files(file_type=file_type)
+        ]
 
     def update_mdt(self, file_path_orig, file_path_conv):
-        mdt_original = datetime.datetime.utcfromtimestamp(
-            os.path.getmtime(file_path_orig)
-        )
-        timestamp = (mdt_original - datetime.datetime(1970, 1, 1)).total_seconds()
-        os.utime(file_path_conv, (timestamp, timestamp))
+        update_mdt(file_path_orig, file_path_conv)
 
     def get_outfile_path(self, outfile):
         outfile_path = os.path.join(
@@ -97,145 +631,413 @@ class MediaConverter:
             os.makedirs(os.path.dirname(outfile_path))
         return outfile_path
 
+    def run_ordered(self, func, jobs):
+        """
+        Run the jobs in a thread pool, see `utils.run_ordered`.
+        """
+        return run_ordered(func, jobs, self.workers)
+
+    def is_current(self, source, outfile, settings):
+        """
+        Check if an output file was already made from the current version of
+        the source file with the current settings.
+        """
+        if self.overwrite:
+            return False
+        return self.manifest.is_current(source, outfile, settings)
+
+    def get_image_settings(self):
+        if self.resize_img:
+            return ["resize", list(self.resize_img_size), self.resize_reducing_gap]
+        return ["copy"]
+
+    def get_mp4_args(self):
+        return list(self.profiles[self.profile]["mp4"])
+
+    def get_webm_args(self):
+        return list(self.profiles[self.profile]["webm"])
+
+    def get_max_bitrate(self, args):
+        """
+        Get the video bitrate ("-b:v") of the output args in bits per second.
+        """
+        try:
+            bitrate = args[args.index("-b:v") + 1].lower()
+        except (ValueError, IndexError):
+            return None
+        multiplier = {"k": 1000, "m": 1000000}.get(bitrate[-1:], 1)
+        try:
+            return int(float(bitrate.rstrip("km")) * multiplier)
+        except ValueError:
+            return None
+
+    def get_ffmpeg_cmd(self, outputs, input_args=None):
+        """
+        Build the ffmpeg command reading a video from stdin (or from other
+        `input_args`) and writing it to each `(args, outfile)` output.
+        Multiple outputs share one read and decode of the source.
+        """
+        cmd = [
+            f"{self.FFMPEG}",
+            "-y",
+            "-loglevel",
+            "error",
+            "-nostats",
+            "-progress",
+            "pipe:1",
+        ]
+        cmd.extend(input_args or ["-i", "-"])
+        for args, outfile in outputs:
+            cmd.extend(args)
+            cmd.extend(["-threads", str(self.ffmpeg_threads), f"{outfile}"])
+        return cmd
+
+    def get_ffprobe_path(self):
+        ffmpeg_dir, ffmpeg_name = os.path.split(self.FFMPEG)
+        return os.path.join(ffmpeg_dir, ffmpeg_name.replace("ffmpeg", "ffprobe"))
+
+    def probe(self, video):
+        """
+        Get the container and streams information of a video with ffprobe.
+        It returns None if ffprobe is not available or fails.
+        """
+        cmd = [
+            self.get_ffprobe_path(),
+            "-v",
+            "error",
+            "-show_entries",
+            "stream=codec_type,codec_name,pix_fmt,bit_rate,channels"
+            ":stream_disposition=attached_pic:format=bit_rate,duration",
+            "-of",
+            "json",
+            video,
+        ]
+        kwargs = {"stdout": subprocess.PIPE, "stderr": subprocess.DEVNULL}
+        if platform.system() == "Windows":
+            kwargs.update(
+                creationflags=subprocess.CREATE_NO_WINDOW,
+            )
+        try:
+            p = subprocess.run(cmd, **kwargs)
+            if p.returncode != 0:
+                return None
+            return json.loads(p.stdout)
+        except (OSError, ValueError):
+            return None
+
+    def classify_video(self, video, probe, ext, args):
+        """
+        Decide how a video has to be converted to the `ext` format. It can be
+        transcoded, only remuxed if its streams already meet the target
+        profile or just copied if it is already a compliant file of the
+        target format.
+        """
+        if not probe:
+            return "transcode"
+        profile = self.TARGET_PROFILES[ext]
+        max_bitrate = self.get_max_bitrate(args)
+        streams = probe.get("streams", [])
+        vstreams = [
+            k
+            for k in streams
+            if k.get("codec_type") == "video"
+            and not k.get("disposition", {}).get("attached_pic")
+        ]
+        astreams = [k for k in streams if k.get("codec_type") == "audio"]
+        if not vstreams:
+            return "transcode"
+        for stream in vstreams:
+            if stream.get("codec_name") not in profile["vcodec"]:
+                return "transcode"
+            if stream.get("pix_fmt") not in profile["pix_fmt"]:
+                return "transcode"
+            if max_bitrate:
+                bitrate = stream.get("bit_rate") or probe.get("format", {}).get(
+                    "bit_rate"
+                )
+                try:
+                    if int(bitrate) > max_bitrate:
+                        return "transcode"
+                except (TypeError, ValueError):
+                    return "transcode"
+        for stream in astreams:
+            if stream.get("codec_name") not in profile["acodec"]:
+                return "transcode"
+            if int(stream.get("channels", 0)) > 2:
+                return "transcode"
+
+        if os.path.splitext(video)[1].lower() == "." + ext:
+            if ext != "mp4" or is_faststart(video):
+                return "copy"
+        return "remux"
+
+    def get_video_settings(self, args):
+        return ["convert", args, self.passthrough]
+
+    def copy_video(self, video, outfile, settings):
+        copy_output(video, outfile, self.copy_strategies)
+        self.manifest.add(video, outfile, settings)
+
+    def get_video_jobs(self, video, outfile):
+        """
+        Return a list of ffmpeg jobs needed to convert a video. Outputs which
+        do not need ffmpeg at all are copied right away. The ffmpeg commands
+        write to temporary files. Long videos are converted in segments.
+        """
+        if not (self.convert2mp4 or self.convert2webm):
+            if not self.is_current(video, outfile, ["copy"]):
+                self.copy_video(video, outfile, ["copy"])
+                self.plan.append((video, outfile, "copy"))
+            return []
+
+        targets = []
+        # "mp4" conversion
+        if self.convert2mp4:
+            targets.append(("mp4", self.get_mp4_args))
+        # "webm" conversion
+        if self.convert2webm:
+            targets.append(("webm", self.get_webm_args))
+
+        probe = None
+        outputs = []
+        transcode_outputs = []
+        for ext, get_args in targets:
+            target_file = self.replace_ext(outfile, ext)
+            args = get_args()
+            settings = self.get_video_settings(args)
+            if self.is_current(video, target_file, settings):
+                continue
+            if probe is None and (self.passthrough or self.segment_min_duration):
+                probe = self.probe(video) or {}
+            action = "transcode"
+            if self.passthrough:
+                action = self.classify_video(video, probe, ext, args)
+            self.plan.append((video, target_file, action))
+            if action == "copy":
+                self.copy_video(video, target_file, settings)
+            elif action == "remux":
+                outputs.append((self.REMUX_ARGS[ext], target_file, settings))
+            else:
+                transcode_outputs.append((args, target_file, settings))
+
+        jobs = []
+        if transcode_outputs and self.is_long_video(probe):
+            conversion = SegmentedConversion(
+                self,
+                video,
+                transcode_outputs,
+                float(probe["format"]["duration"]),
+                any(k.get("codec_type") == "audio" for k in probe["streams"]),
+            )
+            self.conversions.append(conversion)
+            jobs.append(conversion.get_split_job())
+        else:
+            outputs.extend(transcode_outputs)
+
+        def get_job(outputs):
+            cmd = self.get_ffmpeg_cmd([(k[0], get_tmp_path(k[1])) for k in outputs])
+            return FFmpegJob(
+                video, video, [k[1] for k in outputs], [k[2] for k in outputs], cmd
+            )
+
+        if self.single_decode and len(outputs) > 1:
+            # decode the source only once and encode it to all outputs
+            jobs.append(get_job(outputs))
+        else:
+            jobs.extend(get_job([k]) for k in outputs)
+        return jobs
+
+    def is_long_video(self, probe):
+        if not self.segment_min_duration or not probe:
+            return False
+        try:
+            duration = float(probe["format"]["duration"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return duration >= self.segment_min_duration and "streams" in probe
+
+    def start_ffmpeg(self, source, cmd):
+        kwargs = {"stdin": subprocess.DEVNULL}
+        if platform.system() == "Windows":
+            kwargs.update(
+                creationflags=subprocess.CREATE_NO_WINDOW,
+            )
+        if source is None:
+            return FFmpegProcess(cmd, **kwargs)
+        with open(source, "rb") as _stream:
+            kwargs.update(stdin=_stream.raw)
+            return FFmpegProcess(cmd, **kwargs)
+
+    def report_stats(self, running):
+        """
+        Pass the progress of all running ffmpeg jobs to `self.stats_callback`:
+        a list of `(video, out_time, fps, speed)` tuples and the aggregate
+        frames per second of all jobs.
+        """
+        if not self.stats_callback:
+            return
+        files = []
+        total_fps = 0.0
+        for job, p in running:
+            stats = p.stats
+            try:
+                fps = float(stats.get("fps", 0))
+            except ValueError:
+                fps = 0.0
+            total_fps += fps
+            out_time = stats.get("out_time", "00:00:00").split(".")[0]
+            speed = stats.get("speed", "N/A").strip()
+            files.append((job.video, out_time, fps, speed))
+        self.stats_callback({"files": files, "fps": total_fps})
+
+    def get_ffmpeg_threads(self, jobs):
+        """
+        Return the threads of an ffmpeg job when `jobs` jobs are left to run
+        (including the running ones). The workers are split only between the
+        jobs which can run at once, so a single video or the last videos of
+        a batch use all of them.
+        """
+        return max(self.workers // min(self.ffmpeg_jobs, max(jobs, 1)), 1)
+
+    def set_ffmpeg_threads(self, cmd, threads):
+        return [
+            str(threads) if i and cmd[i - 1] == "-threads" else k
+            for i, k in enumerate(cmd)
+        ]
+
+    def run_ffmpeg_jobs(self, jobs):
+        """
+        Run ffmpeg jobs, at most `self.ffmpeg_jobs` at once, and yield
+        `(job, process)` pairs as soon as the processes exit. The consumer
+        may add new jobs to the `jobs` deque while iterating. While the jobs
+        run their progress is reported every `FFMPEG_STATS_INTERVAL` seconds.
+        When the consumer stops iterating (or the stats callback raises) all
+        running ffmpeg processes are killed and their partial (temporary)
+        outputs are removed.
+        """
+        running = []
+        last_report = time.monotonic()
+        try:
+            while jobs or running:
+                while jobs and len(running) < self.ffmpeg_jobs:
+                    job = jobs.popleft()
+                    for outfile in job.outfiles:
+                        prepare_tmp_path(outfile)
+                    threads = self.get_ffmpeg_threads(len(jobs) + len(running) + 1)
+                    cmd = self.set_ffmpeg_threads(job.cmd, threads)
+                    running.append((job, self.start_ffmpeg(job.source, cmd)))
+                finished = [k for k in running if k[1].poll() is not None]
+                if not finished:
+                    if time.monotonic() - last_report >= self.FFMPEG_STATS_INTERVAL:
+                        self.report_stats(running)
+                        last_report = time.monotonic()
+                    time.sleep(self.FFMPEG_POLL_INTERVAL)
+                    continue
+                for job, p in finished:
+                    running.remove((job, p))
+                    p.wait()
+                    yield job, p
+        finally:
+            for job, p in running:
+                p.kill()
+                for outfile in job.outfiles:
+                    remove_file(get_tmp_path(outfile))
+
     def handle(self, *args):
+        try:
+            self.convert()
+        finally:
+            self.manifest.close()
+            for conversion in self.conversions:
+                conversion.cleanup()
+
+    def finish_video_job(self, job, returncode, error):
+        if returncode != 0:
+            self.errors.append((job.video, error))
+        for outfile, settings in zip(job.outfiles, job.settings):
+            tmpfile = get_tmp_path(outfile)
+            if returncode != 0:
+                remove_file(tmpfile)
+                continue
+            if self.keep_mdt:
+                self.update_mdt(job.video, tmpfile)
+            os.replace(tmpfile, outfile)
+            self.manifest.add(job.video, outfile, settings)
+
+    def convert(self):
         i = 1
+        self.plan = []
+        self.errors = []
+        self.conversions = []
 
         # First do the job with images
+        settings = self.get_image_settings()
+        resize_img_size = self.resize_img_size if self.resize_img else None
+        jobs = []
         for image in self.matches_images:
             outfile = self.get_outfile_path(image)
+            if self.is_current(image, outfile, settings):
+                if self.callback:
+                    self.callback(i, image)
+                i = i + 1
+                continue
+            jobs.append(
+                (
+                    image,
+                    outfile,
+                    resize_img_size,
+                    self.keep_mdt,
+                    self.resize_reducing_gap,
+                    self.copy_strategies,
+                )
+            )
 
-            if self.callback:
-                self.callback(i, image)
-            i = i + 1
-
-            if not os.path.isfile(outfile) or self.overwrite:
-                img = Image.open(image)
-                if self.resize_img:
-                    # resize an image
-                    img.thumbnail(self.resize_img_size, Image.ANTIALIAS)
-                    # save it with original exif data
-                    img.save(outfile, exif=img.info["exif"])
-                else:
-                    shutil.copy2(image, outfile)
-
-            if self.keep_mdt:
-                self.update_mdt(image, outfile)
+        with closing(self.run_ordered(convert_image, jobs)) as results:
+            for job, outfile in results:
+                self.manifest.add(job[0], outfile, settings)
+                if self.callback:
+                    self.callback(i, job[0])
+                i = i + 1
 
         # Next do the job with videos
+        remaining = {}
+        jobs = []
         for video in self.matches_videos:
             outfile = self.get_outfile_path(video)
-
+            video_jobs = self.get_video_jobs(video, outfile)
+            if video_jobs:
+                remaining[video] = len(video_jobs)
+                jobs.extend(video_jobs)
+                continue
             if self.callback:
                 self.callback(i, video)
             i = i + 1
 
-            if not (self.convert2mp4 or self.convert2webm):
-                shutil.copy2(video, outfile)
-
-            # "mp4" conversion
-            if self.convert2mp4:
-                outfile = self.replace_ext(outfile, "mp4")
-                if not os.path.isfile(outfile) or self.overwrite:
-                    ffmpeg_mp4 = [
-                        f"{self.FFMPEG}",
-                        "-y",
-                        "-i",
-                        "-",
-                        "-preset",
-                        "fast",
-                        "-pix_fmt",
-                        "yuv420p",
-                        "-vcodec",
-                        "libx264",
-                        "-b:v",
-                        "750k",
-                        "-c:a",
-                        "aac",
-                        "-strict",
-                        "-2",
-                        "-ac",
-                        "2",
-                        "-movflags",
-                        "faststart",
-                        "-qmin",
-                        "10",
-                        "-qmax",
-                        "42",
-                        "-keyint_min",
-                        "150",
-                        "-g",
-                        "150",
-                        "-loglevel",
-                        "error",
-                        "-nostats",
-                        f"{outfile}",
-                    ]
-                    with open(video, "rb") as _stream:
-                        kwargs = {
-                            "stdin": _stream.raw,
-                            "stdout": subprocess.PIPE,
-                            "stderr": subprocess.PIPE,
-                        }
-                        if platform.system() == "Windows":
-                            kwargs.update(
-                                creationflags=subprocess.CREATE_NO_WINDOW,
-                            )
-                        p = subprocess.Popen(ffmpeg_mp4, **kwargs)
-                    stdout, stderr = p.communicate()
-
-                    if self.keep_mdt:
-                        self.update_mdt(video, outfile)
-
-            # "webm" conversion
-            if self.convert2webm:
-                outfile = self.replace_ext(outfile, "webm")
-                if not os.path.isfile(outfile) or self.overwrite:
-                    ffmpeg_webm = [
-                        f"{self.FFMPEG}",
-                        "-y",
-                        "-i",
-                        "-",
-                        "-codec:v",
-                        "libvpx",
-                        "-codec:a",
-                        "vorbis",
-                        "-strict",
-                        "-2",
-                        "-ac",
-                        "2",
-                        "-b:a",
-                        "128k",
-                        # -cpu-used => a critical parameter related
-                        # to the speed of conversion
-                        "-quality",
-                        "good",
-                        "-cpu-used",
-                        "5",
-                        "-qmin",
-                        "0",
-                        "-qmax",
-                        "45",
-                        "-keyint_min",
-                        "150",
-                        "-g",
-                        "150",
-                        "-loglevel",
-                        "error",
-                        "-nostats",
-                        f"{outfile}",
-                    ]
-                    with open(video, "rb") as _stream:
-                        kwargs = {
-                            "stdin": _stream.raw,
-                            "stdout": subprocess.PIPE,
-                            "stderr": subprocess.PIPE,
-                        }
-                        if platform.system() == "Windows":
-                            kwargs.update(
-                                creationflags=subprocess.CREATE_NO_WINDOW,
-                            )
-                        p = subprocess.Popen(ffmpeg_webm, **kwargs)
-                    stdout, stderr = p.communicate()
-
-                    if self.keep_mdt:
-                        self.update_mdt(video, outfile)
+        # start the longest jobs first so the whole batch finishes sooner
+        jobs.sort(key=lambda job: os.path.getsize(job.video), reverse=True)
+        jobs = deque(jobs)
+        with closing(self.run_ffmpeg_jobs(jobs)) as results:
+            for job, p in results:
+                returncode, error = p.returncode, p.error
+                conversion = job.conversion
+                if conversion is not None:
+                    # run the next stage of a segmented conversion first
+                    jobs.extendleft(reversed(conversion.step(job, p)))
+                    if not conversion.pending:
+                        conversion.cleanup()
+                    if not job.outfiles:
+                        if conversion.pending or conversion.error is None:
+                            continue
+                        # the conversion failed before making its outputs
+                        returncode, error = 1, conversion.error
+                        job = job._replace(
+                            outfiles=conversion.outfiles, settings=conversion.settings
+                        )
+                self.finish_video_job(job, returncode, error)
+                if conversion is not None and conversion.pending:
+                    continue
+                remaining[job.video] -= 1
+                if remaining[job.video] == 0:
+                    if self.callback:
+                        self.callback(i, job.video)
+                    i = i + 1
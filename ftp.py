@@ -1,5 +1,11 @@
+import copy
 import os
-from ftplib import FTP, FTP_TLS, error_perm
+from ftplib import FTP, FTP_TLS, all_errors, error_perm
+
+try:
+    from ssl import SSLSocket
+except ImportError:
+    SSLSocket = None
 
 
 class FTPS(FTP_TLS):
@@ -17,6 +23,61 @@ class FTPS(FTP_TLS):
         return conn, size
 
 
+class FTPUploadStream:
+    """
+    A writable file object which sends the written data straight to a file
+    on the FTP server. It works like `FTP.storbinary` but the data is
+    pushed by its producer, so a file (e.g. a zip archive) can be uploaded
+    while it is being made. It is not seekable. `size` is the number of
+    bytes written so far.
+    """
+
+    def __init__(self, ftp, filename, callback=None):
+        self.ftp = ftp
+        self.name = filename
+        self.callback = callback
+        self.closed = False
+        self.size = 0
+        self.ftp.voidcmd("TYPE I")
+        self.conn = self.ftp.transfercmd("STOR " + filename)
+
+    def write(self, data):
+        self.conn.sendall(data)
+        self.size += len(data)
+        if self.callback:
+            self.callback(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self, error=False):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # shutdown the TLS layer like `FTP.storbinary` does
+            if not error and SSLSocket is not None and isinstance(self.conn, SSLSocket):
+                self.conn.unwrap()
+        finally:
+            self.conn.close()
+        if not error:
+            self.ftp.voidresp()
+            return
+        # read the reply to the aborted transfer (e.g. 426 or 226) so the
+        # next command does not get it instead of its own
+        try:
+            self.ftp.getresp()
+        except all_errors:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(error=exc_type is not None)
+
+
 class FTPClient:
     server = None
     account = None
@@ -39,6 +100,16 @@ class FTPClient:
         except (TypeError, ValueError):
             self.port = 21
 
+    def copy(self):
+        """
+        Return a client with the same settings and its own connection, e.g.
+        to upload several files at once.
+        """
+        client = copy.copy(self)
+        client.ftp = None
+        client.connected = False
+        return client
+
     def connect(self):
         if self.connected:
             self.close_connection()
@@ -63,16 +134,47 @@ class FTPClient:
         except IOError:
             self.ftp.mkd(directory)
 
+    def get_size(self, filename):
+        """
+        Return the size of a file in the current FTP directory or `None` if
+        there is no such file.
+        """
+        # some servers refuse SIZE in the ASCII mode
+        self.ftp.voidcmd("TYPE I")
+        try:
+            return self.ftp.size(filename)
+        except error_perm:
+            return None
+
+    def check_size(self, filename, size):
+        """
+        Check that a file in the current FTP directory has the expected size
+        (in bytes), e.g. the size of the local file it was uploaded from.
+        """
+        server_size = self.get_size(filename)
+        if server_size != size:
+            raise Exception(
+                f"The upload of {filename} is incomplete: the FTP server has "
+                f"{server_size or 0} of its {size} bytes."
+            )
+
     def upload(self, filepath, bsize=8192, callback=None, rest_pos=None):
         """ """
         filename = os.path.basename(filepath)
         cmd = "STOR " + filename
-        file_obj = open(filepath, "rb")
-        if rest_pos is not None:
-            file_obj.seek(rest_pos, 0)
-        self.ftp.storbinary(
-            cmd, file_obj, blocksize=bsize, callback=callback, rest=rest_pos
-        )
+        with open(filepath, "rb") as file_obj:
+            if rest_pos is not None:
+                file_obj.seek(rest_pos, 0)
+            self.ftp.storbinary(
+                cmd, file_obj, blocksize=bsize, callback=callback, rest=rest_pos
+            )
+
+    def open_upload(self, filename, callback=None):
+        """
+        Start uploading a file to the current FTP directory and return
+        a writable `FTPUploadStream` for its content.
+        """
+        return FTPUploadStream(self.ftp, filename, callback=callback)
 
     def close_connection(self):
         self.ftp.quit()
@@ -4,13 +4,14 @@ import platform
 import sys
 import subprocess
 import tempfile
-from threading import Thread
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
 import webbrowser
 
 import pytz
 import requests
 from pandas import DataFrame
-from PIL import Image
 
 # Temporary fix for Windows
 # https://github.com/kivy/kivy/pull/7299
@@ -37,6 +38,7 @@ Config.set("graphics", "width", 1500)
 Config.set("input", "mouse", "mouse, disable_multitouch")
 
 from kivy.properties import (
+    ListProperty,
     StringProperty,
     ObjectProperty,
     BooleanProperty,
@@ -61,8 +63,15 @@ from kivy.garden.filebrowser import FileBrowser
 
 # trapper-client imports
 from ftp import FTPClient
-from convert import MediaConverter
-from package import DataPackageGenerator, localize_ignore_dst
+from convert import MediaConverter, load_encoding_profiles
+from media_index import MediaIndex, get_sub_dirs
+from metadata import MetadataCache
+from package import (
+    DataPackageGenerator,
+    TimestampLocalizer,
+    check_zip,
+    get_manifest_path,
+)
 from trapper_con import TrapperConnection
 
 # Force creation of main window
@@ -283,8 +292,7 @@ class TrapperClientScreenManager(ScreenManager):
 
     # continue with uploading after data package generation
     upload_continue = False
-    upload_continue_package_zip = ""
-    upload_continue_package_yaml = ""
+    upload_continue_volumes = []
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -304,6 +312,25 @@ class TrapperClientScreenManager(ScreenManager):
     def get_user_data_path(self):
         return DATA_ROOT
 
+    def get_walk_workers(self, value=""):
+        # the number of directories listed at once; more than one helps
+        # with the media roots on network shares; the value given for a run
+        # overrides the one in the settings
+        if value:
+            try:
+                walk_workers = int(value)
+            except ValueError:
+                walk_workers = 0
+            if walk_workers < 1:
+                raise Exception(
+                    "The number of listing workers has to be a positive integer."
+                )
+            return walk_workers
+        try:
+            return max(int(self.app.config.get("trapper-client", "walk_workers")), 1)
+        except ValueError:
+            return 1
+
     def update_settings(self):
         try:
             settings_dict = self.store.get("settings")["settings"]
@@ -544,6 +571,10 @@ class ConvertScreen(Screen):
     resize_img = BooleanProperty()
     resize_img_size_x = NumericProperty(800)
     resize_img_size_y = NumericProperty(600)
+    workers = NumericProperty(os.cpu_count() or 1)
+    walk_workers = StringProperty("")
+    encoding_profiles = ListProperty([])
+    encoding_profile = StringProperty(MediaConverter.DEFAULT_PROFILE)
     convert2mp4 = BooleanProperty()
     convert2webm = BooleanProperty()
     overwrite = BooleanProperty(False)
@@ -574,6 +605,11 @@ class ConvertScreen(Screen):
         self.img_src_ext.data = [{"text": str(x)} for x in image_ext]
         self.vid_src_ext.data = [{"text": str(x)} for x in video_ext]
 
+        try:
+            self.encoding_profiles = list(load_encoding_profiles())
+        except (OSError, ValueError) as e:
+            self.manager.show_info_popup(str(e))
+
     def show_filechooser(self, target_attr, title):
         self.fch = Filechooser(self, target_attr, title, self.manager.filechooser_last)
         self.fch.show()
@@ -595,14 +631,44 @@ class ConvertScreen(Screen):
             self.stop_thread_convert_flag = False
             raise Exception("The conversion of your media files has been stopped.")
 
+    def stats_callback(self, stats):
+        lines = [
+            "{}: {}, {:.1f} fps, {}".format(os.path.basename(k[0]), k[1], k[2], k[3])
+            for k in stats["files"]
+        ]
+        self.progress_msg = "{}/{} | {:.1f} fps\n{}".format(
+            int(self.pbar.value), self.pbar.max, stats["fps"], "\n".join(lines)
+        )
+        if self.stop_thread_convert_flag:
+            self.stop_thread_convert_flag = False
+            raise Exception("The conversion of your media files has been stopped.")
+
     def thread_convert(self):
         try:
             self.conversion_inprogress = True
             self.media_converter.handle()
+            actions = Counter(k[2] for k in self.media_converter.plan)
             msg = (
                 "Your media were successfully converted!\n"
+                "Videos transcoded: {}, remuxed: {}, copied: {}\n"
                 "You will find your converted media at:\n{}"
-            ).format(self.ids.output_path.text.replace("\\", "/"))
+            ).format(
+                actions["transcode"],
+                actions["remux"],
+                actions["copy"],
+                self.ids.output_path.text.replace("\\", "/"),
+            )
+            if self.media_converter.errors:
+                video, error = self.media_converter.errors[0]
+                msg += (
+                    "\n[color={c}]{n} video(s) could not be converted, e.g.:\n"
+                    "{video}\n{error}[/color]"
+                ).format(
+                    c=self.manager._red,
+                    n=len(self.media_converter.errors),
+                    video=video,
+                    error=error,
+                )
             self.add_continue_button()
 
         except Exception as e:
@@ -645,12 +711,16 @@ class ConvertScreen(Screen):
                 ),
                 convert2mp4=self.convert2mp4.active,
                 convert2webm=self.convert2webm.active,
+                profile=self.encoding_profile,
                 src_ext_images=self.get_selected_images_ext(),
                 src_ext_videos=self.get_selected_videos_ext(),
                 ffmpeg=self.manager.ffmpeg_path,
                 keep_mdt=True,
                 overwrite=self.overwrite.active,
                 callback=self.progress_callback,
+                stats_callback=self.stats_callback,
+                workers=int(self.ids.workers.text),
+                walk_workers=self.manager.get_walk_workers(self.walk_workers),
             )
             self.pbar = ProgressBar(max=self.media_converter.nfiles)
             self.ids.progress_bar.add_widget(self.pbar)
@@ -702,6 +772,9 @@ class PackageScreen(Screen):
     media_root = StringProperty("")
     output_path = StringProperty("")
     package_name = StringProperty("")
+    volume_size = StringProperty("")
+    walk_workers = StringProperty("")
+    previous_package = StringProperty("")
     timezone = None
     username = None
     rproject_id = None
@@ -717,16 +790,27 @@ class PackageScreen(Screen):
     trapper_deployments = None
     btn_continue = None
     package_gen = None
+    # the index of the media root kept only for the template
+    media_index = None
+    metadata_cache = None
+    stop_thread_package_flag = False
+    package_inprogress = False
     pbar = None
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    def get_metadata_cache(self):
+        # the recording dates read from the media files are kept between
+        # the runs, so an unchanged tree does not have to be read again
+        if self.metadata_cache is None:
+            self.metadata_cache = MetadataCache(
+                os.path.join(self.manager.data_dir, MetadataCache.FILENAME)
+            )
+        return self.metadata_cache
+
     def get_sub_dirs(self, root_dir):
-        try:
-            return next(os.walk(root_dir))[1]
-        except Exception:
-            return []
+        return get_sub_dirs(root_dir)
 
     def on_media_root(self, instance, value):
         collections_dirs = self.get_sub_dirs(value)
@@ -781,8 +865,10 @@ class PackageScreen(Screen):
             {"text": str(x), "selected": 0} for x in collections_dirs
         ]
 
-    def show_filechooser(self, target_attr, title):
-        self.fch = Filechooser(self, target_attr, title, self.manager.filechooser_last)
+    def show_filechooser(self, target_attr, title, dirs_only=True):
+        self.fch = Filechooser(
+            self, target_attr, title, self.manager.filechooser_last, dirs_only
+        )
         self.fch.show()
 
     def get_selected_images_ext(self):
@@ -797,18 +883,43 @@ class PackageScreen(Screen):
         sel = [k["text"] for k in self.collections.data if k["selected"]]
         return sel
 
+    def get_volume_size(self):
+        # the maximum size of a package volume in bytes (given in GB)
+        if not self.volume_size:
+            return None
+        try:
+            volume_size = float(self.volume_size.replace(",", "."))
+        except ValueError:
+            volume_size = 0
+        if volume_size <= 0:
+            raise Exception("The volume size has to be a positive number of GB.")
+        return int(volume_size * 1024**3)
+
+    def get_previous_packages(self):
+        # a previous package (or a directory of packages) to append to
+        if not self.previous_package:
+            return None
+        return [self.previous_package]
+
     def get_deployments(self):
         qstr = "?research_project={}".format(self.manager.rproject_id)
         df = self.manager.trapper_con.get_deployments(query_str=qstr)
         self.trapper_deployments = df
 
-    def progress_callback(self, i, fname):
-        self.pbar.value += 1
-        self.progress_msg = "{}/{}\n{}".format(
-            int(self.pbar.value), self.pbar.max, fname
+    def progress_callback(self, nbytes, fname):
+        # the package progress is reported in bytes
+        self.pbar.value += nbytes
+        self.progress_msg = "{:.0f}/{:.0f} MB\n{}".format(
+            self.pbar.value / 1024**2, self.pbar.max / 1024**2, fname
         )
+        if self.stop_thread_package_flag:
+            self.stop_thread_package_flag = False
+            raise Exception(
+                "The packaging has been stopped.\n"
+                "Validate and run it again to continue where it stopped."
+            )
 
-    def package_generator_init(self):
+    def package_generator_init(self, keep_index=False):
         # first check connections
         if not self.check_trapper_connection():
             return
@@ -823,8 +934,17 @@ class PackageScreen(Screen):
             self.validated = False
             return False
 
-        # then try to initiate DataPackageGenerator instance
+        # then try to initiate DataPackageGenerator instance; the media
+        # root is walked once here, the generator keeps only the files to
+        # package and the whole index is kept for the template if asked
         try:
+            media_index = MediaIndex(
+                self.media_root,
+                self.get_selected_images_ext(),
+                self.get_selected_videos_ext(),
+                include=collections_sel,
+                workers=self.manager.get_walk_workers(self.walk_workers),
+            )
             self.package_gen = DataPackageGenerator(
                 data_path=self.media_root,
                 output_path=self.output_path,
@@ -837,7 +957,14 @@ class PackageScreen(Screen):
                 video_ext=self.get_selected_videos_ext(),
                 callback=self.progress_callback,
                 package_name_prefix=self.package_name,
+                metadata_cache=self.get_metadata_cache(),
+                media_index=media_index,
+                volume_size=self.get_volume_size(),
+                previous_packages=self.get_previous_packages(),
+                resume=self.ids.resume_build.active,
             )
+            if keep_index:
+                self.media_index = media_index
             return True
 
         except Exception as e:
@@ -848,7 +975,7 @@ class PackageScreen(Screen):
         Thread(target=self.get_deployments_csv_template, args=()).start()
 
     def get_deployments_csv_template(self):
-        if not self.package_generator_init():
+        if not self.package_generator_init(keep_index=True):
             return
 
         self.progress_msg = 'Generating "deployments_metadata.csv" template ...'
@@ -859,48 +986,39 @@ class PackageScreen(Screen):
             "start": [],
             "end": [],
         }
-        selected_images_ext = self.get_selected_images_ext()
-        selected_videos_ext = self.get_selected_videos_ext()
+        metadata_cache = self.get_metadata_cache()
+        media_index, self.media_index = self.media_index, None
+        localizer = TimestampLocalizer(self.timezone, self.timezone_ignore_dst)
 
         for col in self.package_gen.collections:
-            for root, dirnames, filenames in os.walk(
-                os.path.join(self.media_root, col)
-            ):
-                if os.path.basename(root) == col or not filenames:
+            for relpath, media_dir in media_index.iter_dirs(col):
+                root = media_dir.path
+                if os.path.basename(root) == col or not media_dir.files:
                     continue
 
                 rdates = []
-                for filename in filenames:
-                    file_path = os.path.join(root, filename)
-                    file_ext = os.path.splitext(filename)[1].lower()
-                    if file_ext in selected_images_ext:
-                        try:
-                            rdate = Image.open(file_path)._getexif()[36867]
-                            rdate = datetime.datetime.strptime(
-                                rdate, "%Y:%m:%d %H:%M:%S"
-                            )
-                        except Exception:
-                            rdate = datetime.datetime.fromtimestamp(
-                                os.path.getmtime(file_path)
-                            )
-                    elif file_ext in selected_videos_ext:
-                        rdate = datetime.datetime.fromtimestamp(
-                            os.path.getmtime(file_path)
-                        )
-                    else:
-                        continue
-                    # make datetime object timezone aware
-                    if self.timezone_ignore_dst:
-                        rdate = localize_ignore_dst(rdate, self.timezone)
-                    else:
-                        rdate = self.timezone.localize(rdate)
+                for media_file in media_dir.files:
+                    stat = media_file.stat()
+                    rdate = metadata_cache.get_date_recorded(
+                        media_file.path, media_file.file_type, stat
+                    )
+                    if rdate is None:
+                        rdate = datetime.datetime.fromtimestamp(stat.st_mtime)
                     rdates.append(rdate)
 
                 if not rdates:
                     continue
 
-                data["start"].append(min(rdates))
-                data["end"].append(max(rdates))
+                # compare the dates in UTC and make only the first and the
+                # last one timezone aware
+                utc_dates = localizer.to_utc_many(rdates)
+                for key, func in (("start", min), ("end", max)):
+                    rdate = rdates[utc_dates.index(func(utc_dates))]
+                    if rdate.tzinfo is not None:
+                        rdate = rdate.astimezone(self.timezone)
+                    else:
+                        rdate = localizer.localize(rdate)
+                    data[key].append(rdate)
 
                 dep_id = os.path.basename(root)
                 data["deploymentID"].append(dep_id)
@@ -909,6 +1027,7 @@ class PackageScreen(Screen):
                 except (ValueError, IndexError):
                     loc_id = ""
                 data["locationID"].append(loc_id)
+        metadata_cache.save()
 
         df = DataFrame(
             data,
@@ -944,7 +1063,10 @@ class PackageScreen(Screen):
         errors = []
         # iterate over collections
         for col in self.package_gen.collections:
-            local_deps = self.get_sub_dirs(os.path.join(self.media_root, col))
+            local_deps = self.package_gen.yaml_generator.get_deployments(col)
+            if len(local_deps) == 0 and self.package_gen.previous_packages:
+                # nothing new in the collection
+                continue
             if len(local_deps) == 0:
                 msg = (
                     "Error. The collection [color={c}]{col}[/color] does not "
@@ -977,10 +1099,13 @@ class PackageScreen(Screen):
             self.validated = True
             return 0
 
+    def get_volumes(self):
+        # (yaml, zip) paths of the generated package volumes
+        return [(k.yaml_path, k.zip_path) for k in self.package_gen.volumes]
+
     def move2upload_screen(self, *args):
         self.manager.upload_continue = True
-        self.manager.upload_continue_package_zip = self.package_gen.zip_path
-        self.manager.upload_continue_package_yaml = self.package_gen.yaml_path
+        self.manager.upload_continue_volumes = self.get_volumes()
         self.package_gen = None
         self.ids.progress_bar.clear_widgets()
         self.manager.current = "upload"
@@ -998,28 +1123,87 @@ class PackageScreen(Screen):
         self.ids.progress_bar.add_widget(self.btn_continue)
 
     def thread_package(self):
+        self.package_inprogress = True
         try:
+            self.progress_msg = "Checking the size of your data package.."
+            self.pbar.max = max(self.package_gen.yaml_generator.get_size(), 1)
+            if self.ids.stream_upload.active:
+                self.thread_package_upload()
+                self.package_inprogress = False
+                return
             self.package_gen.run()
             msg = (
                 "Your data package was successfully generated!\n"
                 "You will find it at:\n{}"
             ).format(self.ids.output_path.text.replace("\\", "/"))
+            if len(self.package_gen.volumes) > 1:
+                msg += "\n\nIt has been split into {} volumes.".format(
+                    len(self.package_gen.volumes)
+                )
+            if self.package_gen.previous_packages:
+                msg += "\n\nIt contains only the files new since the previous package."
 
             self.add_continue_button()
 
         except Exception as e:
             msg = str(e)
 
+        self.package_inprogress = False
         self.progress_msg = ""
         self.manager.show_info_popup(msg)
         self.validated = False
 
+    def thread_package_upload(self):
+        # generate the package and stream it to the FTP server at once
+        ftp_con = self.manager.ftp_con
+        try:
+            self.progress_msg = "Connecting to FTP server.."
+            if not ftp_con.connect():
+                raise Exception("Can not connect to the FTP server.")
+            self.package_gen.run_upload(ftp_con, keep_zip=self.ids.keep_zip.active)
+            ftp_con.close_connection()
+        except Exception as e:
+            self.progress_msg = ""
+            self.remove_progress_bar()
+            self.manager.show_info_popup(str(e))
+            self.validated = False
+            return
+
+        volumes = self.get_volumes()
+        upload_screen = self.manager.get_screen("upload")
+        upload_screen.set_volumes(volumes)
+        self.progress_msg = ""
+        self.remove_progress_bar()
+        self.validated = False
+        if upload_screen.ids.trigger_processing.active:
+            Thread(
+                target=upload_screen.thread_trigger_processing, args=(volumes,)
+            ).start()
+        else:
+            msg = (
+                "Your data package was successfully generated and uploaded "
+                "to the FTP server!"
+            )
+            self.manager.show_info_popup(msg)
+
+    @mainthread
+    def remove_progress_bar(self):
+        self.ids.progress_bar.clear_widgets()
+
     def run(self):
         if not self.validated:
             msg = "Please, first validate your input data."
             self.manager.show_info_popup(msg)
             return
 
+        if self.ids.stream_upload.active and self.manager.ftp_con is None:
+            msg = (
+                "You have not set up & verified your FTP connection.\n"
+                "Please check your settings."
+            )
+            self.manager.show_info_popup(msg)
+            return
+
         if self.btn_continue is not None:
             self.ids.progress_bar.clear_widgets()
             self.btn_continue = None
@@ -1029,6 +1213,15 @@ class PackageScreen(Screen):
 
         Thread(target=self.thread_package, args=()).start()
 
+    def stop_thread_package(self):
+        if not self.package_inprogress:
+            msg = "The packaging is not running at the moment."
+            self.manager.show_info_popup(msg)
+            return
+        self.manager.show_loading_popup("Stopping the packaging..")
+        self.ids.progress_bar.clear_widgets()
+        self.stop_thread_package_flag = True
+
 
 ### ---------------------------------------------------------- ###
 ### THE UPLOAD SCREEN
@@ -1042,17 +1235,33 @@ class UploadScreen(Screen):
     trigger_processing_remove_zip = BooleanProperty(False)
     progress_msg = StringProperty("")
     blocksize = 8192
-    uploaded_file = ""
+    # the number of volumes which are uploaded at once
+    UPLOAD_WORKERS = 4
+    # the files which are being uploaded
+    uploaded_files = []
+    progress_lock = Lock()
     stop_thread_upload_flag = ""
     upload_inprogress = False
     pbar = None
+    # (yaml, zip) paths of all volumes of the last generated package
+    volumes = []
 
     @mainthread
     def on_enter(self):
         self.manager.get_ftp_credentials()
         if self.manager.upload_continue:
-            self.data_package_zip = self.manager.upload_continue_package_zip
-            self.data_package_yaml = self.manager.upload_continue_package_yaml
+            self.set_volumes(self.manager.upload_continue_volumes)
+
+    def set_volumes(self, volumes):
+        # the first volume is shown, the rest is uploaded along with it
+        self.volumes = volumes
+        self.data_package_yaml, self.data_package_zip = volumes[0]
+
+    def get_volumes(self):
+        selected = (self.data_package_yaml, self.data_package_zip)
+        if self.volumes and self.volumes[0] == selected:
+            return self.volumes
+        return [selected]
 
     def show_filechooser(self, target_attr, title):
         self.fch = Filechooser(
@@ -1060,10 +1269,22 @@ class UploadScreen(Screen):
         )
         self.fch.show()
 
-    def thread_trigger_processing(self):
+    def thread_trigger_processing(self, volumes=None):
+        if volumes is None:
+            volumes = [(self.data_package_yaml, self.data_package_zip)]
+        # each volume is processed by Trapper as a separate package
+        msgs = []
+        for yaml_path, zip_path in volumes:
+            msg = self.trigger_processing_volume(yaml_path, zip_path)
+            if len(volumes) > 1:
+                msg = f"{os.path.basename(zip_path)}:\n{msg}"
+            msgs.append(msg)
+        self.manager.show_info_popup("\n".join(msgs))
+
+    def trigger_processing_volume(self, yaml_path, zip_path):
         data = {
-            "yaml_file": os.path.basename(self.data_package_yaml),
-            "zip_file": os.path.basename(self.data_package_zip),
+            "yaml_file": os.path.basename(yaml_path),
+            "zip_file": os.path.basename(zip_path),
             "remove_zip": self.ids.trigger_processing_remove_zip.active,
         }
         response = self.manager.trapper_con.collection_process(data)
@@ -1086,89 +1307,106 @@ class UploadScreen(Screen):
                 f"{resp_msg}\n"
                 f"{resp_err}\n"
             )
-        self.manager.show_info_popup(msg)
-
-    @mainthread
-    def add_progress_bar(self, fp_size):
-        self.pbar = ProgressBar(max=fp_size)
-        self.ids.progress_bar.add_widget(self.pbar)
+        return msg
 
     @mainthread
     def remove_progress_bar(self):
         self.ids.progress_bar.clear_widgets()
 
-    def progress_callback(self, *args):
-        self.pbar.value += self.blocksize
-        self.progress_msg = "{}/{}\n{}".format(
-            int(self.pbar.value), self.pbar.max, self.uploaded_file
-        )
+    def progress_callback(self, block):
+        # called by the upload threads with each block sent to the server
+        self.add_progress(len(block))
         if self.stop_thread_upload_flag:
-            # TODO: improve this experimental code
-            self.stop_thread_upload_flag = False
-            try:
-                self.manager.ftp_con.close_connection()
-            except Exception:
-                pass
-            self.manager.ftp_con.connect()
             raise Exception("The upload of your data has been stopped.")
 
-    def thread_upload(self, resume, files2upload):
-        self.progress_msg = "Connecting to FTP server.."
-        self.manager.ftp_con.connect()
-
-        for fp in files2upload:
-            self.uploaded_file = fp
-            fp_size = os.path.getsize(fp)
-
-            # start progress bar
-            self.add_progress_bar(fp_size)
+    def add_progress(self, nbytes):
+        with self.progress_lock:
+            self.pbar.value += nbytes
+            self.progress_msg = "{:.0f}/{:.0f} MB\n{}".format(
+                self.pbar.value / 1024**2,
+                self.pbar.max / 1024**2,
+                "\n".join(self.uploaded_files),
+            )
 
-            # do we want to resume a previous upload?
-            rest_pos = None
-            if resume:
+    def upload_volume(self, resume, files):
+        # upload the files of a volume in order over a connection of its own
+        ftp_con = self.manager.ftp_con.copy()
+        if not ftp_con.connect():
+            raise Exception("Can not connect to the FTP server.")
+        try:
+            # the zip archive must have the files of its manifest
+            for fp in files:
+                if fp.lower().endswith(".zip") and get_manifest_path(fp) in files:
+                    check_zip(fp, get_manifest_path(fp))
+            ftp_con.set_ftp_directory("/collections")
+            for fp in files:
+                filename = os.path.basename(fp)
+                size = os.path.getsize(fp)
+                # resume a previous upload; the files which are not on the
+                # server yet (or are bigger there) are uploaded from the start
+                rest_pos = None
+                if resume:
+                    rest_pos = ftp_con.get_size(filename)
+                    if rest_pos is not None and rest_pos > size:
+                        rest_pos = None
+                    if rest_pos:
+                        self.add_progress(rest_pos)
+                    if rest_pos == size:
+                        continue
+                with self.progress_lock:
+                    self.uploaded_files.append(fp)
                 try:
-                    self.manager.ftp_con.set_ftp_directory("/collections")
-                    rest_pos = self.manager.ftp_con.ftp.size(os.path.basename(fp))
-                    if rest_pos is None:
-                        raise Exception()
-                except Exception:
-                    msg = (
-                        "Can not resume a previous upload. "
-                        "There is no such a file on the FTP server."
+                    ftp_con.upload(
+                        fp,
+                        bsize=self.blocksize,
+                        callback=self.progress_callback,
+                        rest_pos=rest_pos,
                     )
-                    self.manager.show_info_popup(msg)
-                    self.remove_progress_bar()
-                    self.progress_msg = ""
-                    return
-                self.pbar.value = rest_pos
-
-            # if we have working FTP connection try to upload a package
+                finally:
+                    with self.progress_lock:
+                        self.uploaded_files.remove(fp)
+                ftp_con.check_size(filename, size)
+        finally:
             try:
-                self.manager.ftp_con.set_ftp_directory("/collections")
-                self.upload_inprogress = True
-                self.manager.ftp_con.upload(
-                    fp,  # filepath,
-                    bsize=self.blocksize,
-                    callback=self.progress_callback,
-                    rest_pos=rest_pos,
-                )
-            except Exception as e:
-                msg = str(e)
-                self.manager.show_info_popup(msg)
-                self.remove_progress_bar()
-                self.progress_msg = ""
-                self.upload_inprogress = False
-                return
+                ftp_con.close_connection()
+            except Exception:
+                # e.g. after an aborted transfer
+                ftp_con.ftp.close()
 
-            self.progress_msg = ""
-            self.remove_progress_bar()
+    def thread_upload(self, resume, volume_files, volumes=None):
+        self.progress_msg = "Connecting to FTP server.."
+        self.uploaded_files = []
+        # the volumes are uploaded concurrently, each one by its own thread
+        errors = []
+        workers = min(len(volume_files), self.UPLOAD_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                (files, executor.submit(self.upload_volume, resume, files))
+                for files in volume_files
+            ]
+            for files, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((files, str(e)))
 
-        self.manager.ftp_con.close_connection()
+        self.stop_thread_upload_flag = False
         self.upload_inprogress = False
+        self.progress_msg = ""
+        self.remove_progress_bar()
+
+        if errors:
+            msgs = [msg for files, msg in errors]
+            if len(volume_files) > 1:
+                msgs = [
+                    f"{os.path.basename(files[0])}:\n{msg}" for files, msg in errors
+                ]
+            self.manager.show_info_popup("\n".join(msgs))
+            return
 
         if self.ids.trigger_processing.active:
             # start trigger processing thread
-            Thread(target=self.thread_trigger_processing).start()
+            Thread(target=self.thread_trigger_processing, args=(volumes,)).start()
         else:
             msg = "Your data package has been successfully uploaded to Trapper!"
             self.manager.show_info_popup(msg)
@@ -1183,24 +1421,46 @@ class UploadScreen(Screen):
             self.manager.show_info_popup(msg)
             return
 
-        files2upload = [k for k in [self.data_package_yaml, self.data_package_zip] if k]
+        if self.upload_inprogress:
+            msg = "The upload is already running."
+            self.manager.show_info_popup(msg)
+            return
 
-        if not files2upload:
+        volumes = self.get_volumes()
+        volume_files = []
+        for yaml_path, zip_path in volumes:
+            files = [k for k in [yaml_path, zip_path] if k]
+            # the manifest of the package (if there is one) lets the
+            # uploaded files be checked against their SHA-256
+            if zip_path and os.path.isfile(get_manifest_path(zip_path)):
+                files.append(get_manifest_path(zip_path))
+            if files:
+                volume_files.append(files)
+
+        if not volume_files:
             msg = "There are no files to upload."
             self.manager.show_info_popup(msg)
             self.progress_msg = ""
             return
 
         # Check provided file paths
-        for fp in files2upload:
+        for fp in (k for files in volume_files for k in files):
             if not os.path.isfile(fp):
                 msg = f"There is no file {fp}."
                 self.manager.show_info_popup(msg)
                 self.progress_msg = ""
                 return
 
+        # start progress bar
+        self.pbar = ProgressBar(
+            max=sum(os.path.getsize(k) for files in volume_files for k in files)
+        )
+        self.ids.progress_bar.clear_widgets()
+        self.ids.progress_bar.add_widget(self.pbar)
+
         # start upload thread
-        Thread(target=self.thread_upload, args=(resume, files2upload)).start()
+        self.upload_inprogress = True
+        Thread(target=self.thread_upload, args=(resume, volume_files, volumes)).start()
 
     def stop_thread_upload(self):
         if not self.upload_inprogress:
@@ -1238,6 +1498,7 @@ class TrapperApp(App):
                 "ftp_pass": "",
                 "image_ext": ",".join(DEFAULT_SRC_EXT_IMAGES),
                 "video_ext": ",".join(DEFAULT_SRC_EXT_VIDEOS),
+                "walk_workers": 1,
             },
         )
 
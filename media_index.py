@@ -0,0 +1,241 @@
+"""
+The index of a media root made in a single `os.scandir` walk. It is shared
+by the conversion, the packaging and the GUI so the tree is not walked
+again by each of them and the file types are not checked with extra stats.
+"""
+
+import os
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# the prefix of the temporary files and directories of a conversion; an
+# interrupted run may leave them behind, so they are never indexed
+TMP_PREFIX = ".tmp-"
+
+
+class MediaFile(namedtuple("MediaFile", ["entry", "file_type"])):
+    """
+    A media file found by the walk: its `os.DirEntry` (which caches the
+    result of `stat()`) and its type, "image" or "video".
+    """
+
+    __slots__ = ()
+
+    @property
+    def path(self):
+        return self.entry.path
+
+    @property
+    def name(self):
+        return self.entry.name
+
+    def stat(self):
+        return self.entry.stat()
+
+
+# a directory of the index; `dirs` are the names of its sub-directories
+# and `files` the media files it contains
+MediaDir = namedtuple("MediaDir", ["path", "dirs", "files"])
+
+
+def get_sub_dirs(path):
+    """
+    Return the names of the sub-directories of `path` (in the order they
+    are listed by the OS) or an empty list if it cannot be listed. The
+    temporary directories of a conversion are left out.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return [
+                k.name
+                for k in entries
+                if k.is_dir() and not k.name.startswith(TMP_PREFIX)
+            ]
+    except OSError:
+        return []
+
+
+def is_parent_dir(parent, path):
+    """
+    Tell whether `parent` is the directory `path` itself or one of its
+    parents. Both paths are real (see `os.path.realpath`).
+    """
+    return path == parent or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+
+class MediaIndex:
+    """
+    The expected structure of the media root is `collection/deployment/files`
+    but the walk is recursive so any layout can be indexed. Only the files
+    with one of the image or video extensions are kept. The directories
+    are visited in the same (top-down) order as with `os.walk`.
+
+    With more than one worker the directories are listed concurrently in
+    a thread pool (with a bounded number of listings in flight), which
+    hides the round trip latency of network shares (SMB/NFS).
+    """
+
+    def __init__(self, root, image_ext=None, video_ext=None, include=None, workers=1):
+        self.root = root
+        self.image_ext = list(image_ext or [])
+        self.video_ext = list(video_ext or [])
+        self.workers = max(int(workers or 1), 1)
+        # relative path (with "/" separators) -> MediaDir
+        self.dirs = {}
+        if include is None:
+            self.walk(root, "")
+        else:
+            # index only the given top-level directories
+            self.dirs[""] = MediaDir(root, list(include), [])
+            for name in include:
+                self.walk(os.path.join(root, name), name)
+
+    def get_file_type(self, filename):
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in self.image_ext:
+            return "image"
+        if ext in self.video_ext:
+            return "video"
+        return None
+
+    def scan_dir(self, path, parents=()):
+        """
+        List a directory and return its `MediaDir` and a dict of the symbolic
+        links to directories in it, or `(None, {})` if it cannot be listed
+        (unreadable directories are skipped like with `os.walk`). The
+        temporary files and directories of a conversion are skipped.
+
+        The links are listed and walked like the other directories, but
+        a link to a directory of its own walk would make the walk loop, so
+        it is mapped to None. `parents` are the real paths of the
+        directories in which the walk went through a link; the other links
+        are mapped to the `parents` of their own walk.
+        """
+        try:
+            with os.scandir(path) as entries:
+                entries = list(entries)
+        except OSError:
+            return None, {}
+        media_dir = MediaDir(path, [], [])
+        links = {}
+        real_path = None
+        for entry in entries:
+            if entry.name.startswith(TMP_PREFIX):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    media_dir.dirs.append(entry.name)
+                    continue
+                if entry.is_symlink() and entry.is_dir():
+                    if real_path is None:
+                        real_path = os.path.realpath(path)
+                    target = os.path.realpath(entry.path)
+                    media_dir.dirs.append(entry.name)
+                    links[entry.name] = parents + (real_path,)
+                    if any(is_parent_dir(target, k) for k in links[entry.name]):
+                        links[entry.name] = None
+                    continue
+                file_type = self.get_file_type(entry.name)
+                if file_type is not None and entry.is_file():
+                    media_dir.files.append(MediaFile(entry, file_type))
+            except OSError:
+                pass
+        return media_dir, links
+
+    def walk(self, path, relpath):
+        scanned = self.scan_tree(path, relpath)
+        # add the directories in the top-down order; the sub-directories
+        # are pushed in reverse so they are popped in the listing order
+        stack = [relpath]
+        while stack:
+            relpath = stack.pop()
+            media_dir = scanned.get(relpath)
+            if media_dir is None:
+                continue
+            self.dirs[relpath] = media_dir
+            for name in reversed(media_dir.dirs):
+                stack.append(self.join(relpath, name))
+
+    def add_scanned(self, scanned, queue, job, result):
+        """
+        Add the result of `scan_dir` for a `(path, relpath, parents)` job to
+        the `scanned` directories and queue the jobs of its sub-directories.
+        """
+        path, relpath, parents = job
+        media_dir, links = result
+        scanned[relpath] = media_dir
+        if media_dir is None:
+            return
+        for name in media_dir.dirs:
+            sub_path = os.path.join(path, name)
+            sub_relpath = self.join(relpath, name)
+            sub_parents = links.get(name, parents)
+            if sub_parents is None:
+                # a link to a directory of its own walk is listed, not walked
+                scanned[sub_relpath] = MediaDir(sub_path, [], [])
+            else:
+                queue.append((sub_path, sub_relpath, sub_parents))
+
+    def scan_tree(self, path, relpath):
+        """
+        List all the directories of a tree and return a dict of their
+        relative paths and `MediaDir`s (in no particular order).
+        """
+        scanned = {}
+        queue = deque([(path, relpath, ())])
+        if self.workers == 1:
+            while queue:
+                job = queue.popleft()
+                self.add_scanned(scanned, queue, job, self.scan_dir(job[0], job[2]))
+            return scanned
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            running = {}
+            while queue or running:
+                while queue and len(running) < self.workers * 2:
+                    job = queue.popleft()
+                    running[executor.submit(self.scan_dir, job[0], job[2])] = job
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    self.add_scanned(scanned, queue, job, future.result())
+        return scanned
+
+    def join(self, *parts):
+        return "/".join(k for k in parts if k)
+
+    def get_dir(self, *parts):
+        """
+        Return the indexed `MediaDir` of the path given by its parts
+        relative to the media root, e.g. `get_dir(collection, deployment)`.
+        """
+        try:
+            return self.dirs[self.join(*parts)]
+        except KeyError:
+            raise Exception(f"There is no directory: {os.path.join(self.root, *parts)}")
+
+    def get_sub_dirs(self, *parts):
+        return list(self.get_dir(*parts).dirs)
+
+    def get_files(self, *parts, file_type=None):
+        return [
+            k
+            for k in self.get_dir(*parts).files
+            if file_type is None or k.file_type == file_type
+        ]
+
+    def iter_dirs(self, *parts):
+        """
+        Yield `(relpath, MediaDir)` of the directory given by its parts and
+        all its sub-directories in the top-down order.
+        """
+        prefix = self.join(*parts)
+        for relpath, media_dir in self.dirs.items():
+            if not prefix or relpath == prefix or relpath.startswith(prefix + "/"):
+                yield relpath, media_dir
+
+    def iter_files(self, *parts, file_type=None):
+        for relpath, media_dir in self.iter_dirs(*parts):
+            for media_file in media_dir.files:
+                if file_type is None or media_file.file_type == file_type:
+                    yield media_file
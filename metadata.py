@@ -0,0 +1,313 @@
+"""
+Minimal readers of the recording date embedded in camera trap media files.
+They parse only the few header bytes needed instead of the whole metadata.
+"""
+
+import datetime
+import os
+import struct
+
+from PIL import Image
+
+from utils import SQLiteStore
+
+EXIF_DATETIME_FORMAT = "%Y:%m:%d %H:%M:%S"
+# TIFF tags
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TIFF_TYPE_ASCII = 2
+
+# JPEG markers
+JPEG_SOI = b"\xff\xd8"
+JPEG_APP1 = 0xE1
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+# markers without a length field
+JPEG_STANDALONE = {0x01, *range(0xD0, 0xD8)}
+
+# the epoch of the MP4/QuickTime timestamps
+MP4_EPOCH = datetime.datetime(1904, 1, 1, tzinfo=datetime.timezone.utc)
+# the formats of the AVI "IDIT" and "ICRD" chunks written by cameras
+RIFF_DATETIME_FORMATS = (
+    "%a %b %d %H:%M:%S %Y",
+    EXIF_DATETIME_FORMAT,
+    "%Y-%m-%d %H:%M:%S",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y-%m-%d",
+)
+
+
+def parse_exif_datetime(value):
+    try:
+        return datetime.datetime.strptime(value, EXIF_DATETIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_tiff_tag(tiff, ifd_offset, tag):
+    """
+    Return `(type, count, value_offset)` of a tag from the TIFF IFD starting
+    at `ifd_offset` or None if the IFD does not contain the tag.
+    """
+    order = "<" if tiff[:2] == b"II" else ">"
+    (n_entries,) = struct.unpack_from(order + "H", tiff, ifd_offset)
+    for i in range(n_entries):
+        entry = ifd_offset + 2 + i * 12
+        _tag, _type, count = struct.unpack_from(order + "HHI", tiff, entry)
+        if _tag == tag:
+            if _type == TIFF_TYPE_ASCII and count <= 4:
+                return _type, count, entry + 8
+            (value,) = struct.unpack_from(order + "I", tiff, entry + 8)
+            return _type, count, value
+    return None
+
+
+def get_tiff_datetime_original(tiff):
+    """
+    Return the raw DateTimeOriginal value from an EXIF (TIFF) block.
+    """
+    if tiff[:4] not in (b"II*\x00", b"MM\x00*"):
+        raise ValueError("Not a TIFF header")
+    order = "<" if tiff[:2] == b"II" else ">"
+    (ifd0,) = struct.unpack_from(order + "I", tiff, 4)
+    # the tag belongs to the Exif IFD but some writers put it into IFD0
+    entry = get_tiff_tag(tiff, ifd0, TAG_DATETIME_ORIGINAL)
+    if entry is None:
+        exif_ifd = get_tiff_tag(tiff, ifd0, TAG_EXIF_IFD)
+        if exif_ifd is None:
+            return None
+        entry = get_tiff_tag(tiff, exif_ifd[2], TAG_DATETIME_ORIGINAL)
+        if entry is None:
+            return None
+    _type, count, offset = entry
+    if _type != TIFF_TYPE_ASCII or offset + count > len(tiff):
+        raise ValueError("Invalid DateTimeOriginal tag")
+    return tiff[offset : offset + count].split(b"\x00", 1)[0].decode("latin-1")
+
+
+def read_jpeg_exif(_file):
+    """
+    Return the EXIF (TIFF) block of a JPEG file or None if there is no such
+    block. Only the segments before the image data are read.
+    """
+    if _file.read(2) != JPEG_SOI:
+        raise ValueError("Not a JPEG file")
+    while True:
+        byte = _file.read(1)
+        if byte != b"\xff":
+            raise ValueError("Invalid JPEG marker")
+        # markers can be padded with any number of 0xFF bytes
+        while byte == b"\xff":
+            byte = _file.read(1)
+        if not byte:
+            raise ValueError("Truncated JPEG file")
+        marker = byte[0]
+        if marker in (JPEG_SOS, JPEG_EOI):
+            return None
+        if marker in JPEG_STANDALONE:
+            continue
+        (length,) = struct.unpack(">H", _file.read(2))
+        if marker == JPEG_APP1:
+            data = _file.read(length - 2)
+            if data[:6] == b"Exif\x00\x00":
+                return data[6:]
+        else:
+            _file.seek(length - 2, 1)
+
+
+def read_datetime_original(filepath):
+    """
+    Return the EXIF DateTimeOriginal of an image as a naive datetime or
+    None if it is not available. JPEG headers are parsed directly; other
+    layouts (or JPEG files this parser does not understand) are handed
+    over to Pillow.
+    """
+    try:
+        with open(filepath, "rb") as _file:
+            tiff = read_jpeg_exif(_file)
+        if tiff is None:
+            return None
+        return parse_exif_datetime(get_tiff_datetime_original(tiff))
+    except OSError:
+        return None
+    except (ValueError, struct.error):
+        pass
+
+    try:
+        with Image.open(filepath) as image:
+            return parse_exif_datetime(image._getexif()[TAG_DATETIME_ORIGINAL])
+    except Exception:
+        return None
+
+
+def iter_mp4_boxes(_file, end=None):
+    """
+    Yield `(type, payload_size)` of the boxes from the current position up
+    to `end` (or the end of the file). The file is positioned at the
+    payload of the yielded box and the next box is found by seeking, so
+    only the box headers are read.
+    """
+    while end is None or _file.tell() + 8 <= end:
+        start = _file.tell()
+        header = _file.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", _file.read(8))
+            header_size = 16
+        elif size == 0:
+            # the box extends to the end of the file
+            yield box_type, None
+            return
+        if size < header_size:
+            raise ValueError("Invalid MP4 box size")
+        yield box_type, size - header_size
+        _file.seek(start + size)
+
+
+def read_mp4_creation_time(_file):
+    """
+    Return the `creation_time` of the "mvhd" box of an MP4/MOV file as an
+    aware UTC datetime or None if it is not set.
+    """
+    for box_type, size in iter_mp4_boxes(_file):
+        if box_type != b"moov":
+            continue
+        end = None if size is None else _file.tell() + size
+        for child_type, child_size in iter_mp4_boxes(_file, end):
+            if child_type != b"mvhd":
+                continue
+            version = _file.read(4)[0]
+            if version == 1:
+                (seconds,) = struct.unpack(">Q", _file.read(8))
+            else:
+                (seconds,) = struct.unpack(">I", _file.read(4))
+            if seconds == 0:
+                return None
+            return MP4_EPOCH + datetime.timedelta(seconds=seconds)
+        return None
+    return None
+
+
+def parse_riff_datetime(value):
+    value = value.split(b"\x00", 1)[0].decode("latin-1").strip()
+    for dt_format in RIFF_DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, dt_format)
+        except ValueError:
+            pass
+    return None
+
+
+def read_avi_datetime(_file):
+    """
+    Return the recording date of an AVI file as a naive datetime from its
+    "IDIT" chunk (in the "hdrl" list) or "ICRD" chunk (in the "INFO" list)
+    or None if there is none. The "movi" list is skipped by seeking.
+    """
+    header = _file.read(12)
+    if header[:4] != b"RIFF" or header[8:] != b"AVI ":
+        raise ValueError("Not an AVI file")
+    # the chunks nested in the LIST chunks are walked in the same loop
+    ends = [struct.unpack("<I", header[4:8])[0] + 8]
+    created = None
+    while ends:
+        if _file.tell() + 8 > ends[-1]:
+            _file.seek(ends.pop())
+            continue
+        header = _file.read(8)
+        if len(header) < 8:
+            break
+        chunk_id, size = struct.unpack("<4sI", header)
+        # chunks are padded to an even size
+        end = _file.tell() + size + (size & 1)
+        if chunk_id == b"LIST":
+            if _file.read(4) in (b"hdrl", b"INFO"):
+                ends.append(end)
+                continue
+        elif chunk_id == b"IDIT":
+            dt = parse_riff_datetime(_file.read(size))
+            if dt is not None:
+                return dt
+        elif chunk_id == b"ICRD" and created is None:
+            created = parse_riff_datetime(_file.read(size))
+        _file.seek(end)
+    return created
+
+
+def read_creation_time(filepath):
+    """
+    Return the recording date stored in the header of a video file or None
+    if it is not available. MP4/MOV/M4V files give an aware UTC datetime
+    (as defined by the format), AVI files a naive local datetime.
+    """
+    try:
+        with open(filepath, "rb") as _file:
+            if _file.read(12)[:4] == b"RIFF":
+                _file.seek(0)
+                return read_avi_datetime(_file)
+            _file.seek(0)
+            return read_mp4_creation_time(_file)
+    except (OSError, ValueError, IndexError, OverflowError, struct.error):
+        return None
+
+
+def read_date_recorded(filepath, file_type):
+    """
+    Return the recording date stored in an "image" or "video" file or None
+    if it is not available.
+    """
+    if file_type == "image":
+        return read_datetime_original(filepath)
+    if file_type == "video":
+        return read_creation_time(filepath)
+    return None
+
+
+class MetadataCache(SQLiteStore):
+    """
+    The SQLite database which remembers the recording dates read from the
+    media files, keyed by the file path, size and modification time. It lets
+    regenerating a template or a package of an unchanged tree skip reading
+    the files. It can be shared by threads.
+    """
+
+    FILENAME = "metadata_cache.sqlite3"
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+        "file_type TEXT, date_recorded TEXT)"
+    )
+
+    def get_key(self, filepath):
+        return os.path.abspath(filepath).replace("\\", "/")
+
+    def get_date_recorded(self, filepath, file_type, stat=None):
+        """
+        The cached version of `read_date_recorded`. A `stat` result of the
+        file can be given if it is already known.
+        """
+        key = self.get_key(filepath)
+        if stat is None:
+            stat = os.stat(filepath)
+        row = self.fetchone(
+            "SELECT size, mtime, file_type, date_recorded FROM files WHERE path = ?",
+            (key,),
+        )
+        if row is not None and row[:3] == (stat.st_size, stat.st_mtime_ns, file_type):
+            return datetime.datetime.fromisoformat(row[3]) if row[3] else None
+
+        dt = read_date_recorded(filepath, file_type)
+        self.write(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            (
+                key,
+                stat.st_size,
+                stat.st_mtime_ns,
+                file_type,
+                dt.isoformat() if dt else None,
+            ),
+        )
+        return dt
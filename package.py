@@ -1,19 +1,65 @@
 """
 TODO: docstrings
 """
+
+import bisect
+import copy
+import csv
+import hashlib
+import itertools
+import json
 import os
 import logging
 import datetime
+import queue
+import re
+import struct
+import threading
 import zipfile
-from collections import OrderedDict
+import zlib
+from collections import OrderedDict, namedtuple
+from contextlib import ExitStack, closing
 
 import yaml
-from PIL import Image
 import pytz
 
+from media_index import MediaIndex
+from metadata import read_date_recorded
+from utils import run_ordered
 
 # YAML mapping extension
 _mapping_tag = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
+_sequence_tag = yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG
+
+# the C (libyaml) emitter is much faster than the pure Python one
+YAMLDumper = getattr(yaml, "CDumper", yaml.Dumper)
+
+# an upper estimate of the bytes a zip entry adds to the size of its file
+# (the local header, the data descriptor and the central directory record
+# with the ZIP64 extras and the path of the file)
+ZIP_ENTRY_OVERHEAD = 512
+
+# the size of the chunks in which the files are read into the zip archive
+# and the number of chunks which can be read ahead of the zip writer
+ZIP_CHUNK_SIZE = 1024 * 1024
+READ_AHEAD_BUFFERS = 8
+
+MANIFEST_SUFFIX = "_manifest.csv"
+MANIFEST_FIELDS = ["file", "size", "mtime", "sha256"]
+
+# the number of resources whose recording dates are converted to UTC
+# timestamps at once
+DATES_BATCH_SIZE = 1024
+
+# the checkpoint of an unfinished package build; it is removed when the
+# build is complete
+CHECKPOINT_SUFFIX = "_checkpoint.json"
+VOLUME_SUFFIX_RE = re.compile(r"_vol\d{3}$")
+
+# a part of the package with its own YAML definition and zip archive
+PackageVolume = namedtuple(
+    "PackageVolume", ["yaml_generator", "yaml_path", "zip_path", "manifest_path"]
+)
 
 
 def dict_representer(dumper, data):
@@ -28,6 +74,36 @@ yaml.add_representer(OrderedDict, dict_representer)
 yaml.add_constructor(_mapping_tag, dict_constructor)
 
 
+def iter_node_events(node, resolver):
+    """
+    Yield the events of a represented YAML node in the same way as
+    `yaml.serializer.Serializer` does, but without anchors and aliases
+    (the definitions never contain the same object twice).
+    """
+    if isinstance(node, yaml.ScalarNode):
+        detected_tag = resolver.resolve(yaml.ScalarNode, node.value, (True, False))
+        default_tag = resolver.resolve(yaml.ScalarNode, node.value, (False, True))
+        implicit = (node.tag == detected_tag), (node.tag == default_tag)
+        yield yaml.ScalarEvent(None, node.tag, implicit, node.value, style=node.style)
+    elif isinstance(node, yaml.SequenceNode):
+        implicit = node.tag == resolver.resolve(yaml.SequenceNode, node.value, True)
+        yield yaml.SequenceStartEvent(
+            None, node.tag, implicit, flow_style=node.flow_style
+        )
+        for item in node.value:
+            yield from iter_node_events(item, resolver)
+        yield yaml.SequenceEndEvent()
+    else:
+        implicit = node.tag == resolver.resolve(yaml.MappingNode, node.value, True)
+        yield yaml.MappingStartEvent(
+            None, node.tag, implicit, flow_style=node.flow_style
+        )
+        for key, value in node.value:
+            yield from iter_node_events(key, resolver)
+            yield from iter_node_events(value, resolver)
+        yield yaml.MappingEndEvent()
+
+
 # datetime localize function which ignores DST
 def localize_ignore_dst(dt, zoneinfo):
     utc_offset = zoneinfo.utcoffset(dt)
@@ -37,11 +113,384 @@ def localize_ignore_dst(dt, zoneinfo):
     return dt.astimezone(zoneinfo)
 
 
+class TimestampLocalizer:
+    """
+    Convert datetimes recorded in a timezone to UTC timestamps in bulk. The
+    UTC offset of a naive datetime is the same for all datetimes between
+    two transitions of the timezone (outside of the ambiguous or missing
+    local times around a transition), so it is resolved once per such
+    interval and cached. The offset is resolved with the same `localize`
+    (or `localize_ignore_dst`) call as for a single datetime, and the
+    datetimes around a transition are always resolved one by one, so the
+    results are identical.
+    """
+
+    UTC_FORMAT = "%Y-%m-%dT%H:%M:%S+0000"
+
+    def __init__(self, zoneinfo, ignore_dst=False):
+        self.zoneinfo = zoneinfo
+        self.ignore_dst = ignore_dst
+        # the interval index -> UTC offset
+        self.offsets = {}
+        # the local times [start, end) around each transition where the
+        # offset is ambiguous or the local time is missing, flattened
+        self.bounds = []
+        transitions = getattr(zoneinfo, "_utc_transition_times", [])
+        infos = getattr(zoneinfo, "_transition_info", [])
+        for i in range(1, len(transitions)):
+            before, after = infos[i - 1][0], infos[i][0]
+            start = transitions[i] + min(before, after)
+            end = transitions[i] + max(before, after)
+            if self.bounds and start <= self.bounds[-1]:
+                # merge the windows of transitions close to each other
+                self.bounds[-1] = max(self.bounds[-1], end)
+            else:
+                self.bounds.extend([start, end])
+
+    def localize(self, dt):
+        """
+        Make a naive datetime timezone aware as it was done for a single
+        datetime so far.
+        """
+        if self.ignore_dst:
+            return localize_ignore_dst(dt, self.zoneinfo)
+        return self.zoneinfo.localize(dt)
+
+    def resolve_utc_offset(self, dt):
+        if self.ignore_dst:
+            # the standard offset used by `localize_ignore_dst`
+            return self.zoneinfo.utcoffset(dt) - self.zoneinfo.dst(dt)
+        return self.zoneinfo.localize(dt).utcoffset()
+
+    def get_utc_offset(self, dt):
+        i = bisect.bisect_right(self.bounds, dt)
+        if i % 2:
+            # around a transition
+            return self.resolve_utc_offset(dt)
+        try:
+            return self.offsets[i]
+        except KeyError:
+            offset = self.offsets[i] = self.resolve_utc_offset(dt)
+            return offset
+
+    def to_utc(self, dt):
+        """
+        Return a (naive or aware) datetime as a naive UTC datetime.
+        """
+        if dt.tzinfo is not None:
+            return dt.astimezone(pytz.utc).replace(tzinfo=None)
+        return dt - self.get_utc_offset(dt)
+
+    def format_utc(self, dt):
+        return self.to_utc(dt).strftime(self.UTC_FORMAT)
+
+    def to_utc_many(self, dts):
+        """
+        Return a list of naive UTC datetimes of a sequence of (naive or
+        aware) datetimes.
+        """
+        return [self.to_utc(dt) for dt in dts]
+
+    def format_utc_many(self, dts):
+        """
+        Return a list of ISO 8601 UTC timestamps of a sequence of (naive
+        or aware) datetimes.
+        """
+        return [k.strftime(self.UTC_FORMAT) for k in self.to_utc_many(dts)]
+
+
+class Tee:
+    """
+    A writable file object which writes the data to all given file objects,
+    e.g. to the FTP server and to a local copy.
+    """
+
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+        return len(data)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+
+class ReadAhead:
+    """
+    Reads files in a background thread into a bounded pool of large buffers
+    so reading the next files (e.g. from a slow SD card or USB disk) overlaps
+    with writing the current one to another disk or a network. The reader
+    also computes the SHA-256 of the files.
+    """
+
+    def __init__(self, files, chunk_size=ZIP_CHUNK_SIZE, buffers=READ_AHEAD_BUFFERS):
+        self.files = files
+        self.free = queue.Queue()
+        for i in range(max(buffers, 2)):
+            self.free.put(bytearray(chunk_size))
+        # the messages of the reader: ("file", (path, stat)), ("data", (buf, n)),
+        # ("sha256", digest), ("error", exception) and ("done", None)
+        self.filled = queue.Queue()
+        self.sha256 = None
+        self.thread = threading.Thread(target=self.read, daemon=True)
+
+    def read(self):
+        try:
+            for filepath in self.files:
+                sha256 = hashlib.sha256()
+                with open(filepath, "rb") as src:
+                    self.filled.put(("file", (filepath, os.fstat(src.fileno()))))
+                    while True:
+                        buf = self.free.get()
+                        if buf is None:
+                            # stopped by `close`
+                            return
+                        n = src.readinto(buf)
+                        if not n:
+                            self.free.put(buf)
+                            break
+                        sha256.update(memoryview(buf)[:n])
+                        self.filled.put(("data", (buf, n)))
+                self.filled.put(("sha256", sha256.hexdigest()))
+        except Exception as e:
+            self.filled.put(("error", e))
+        else:
+            self.filled.put(("done", None))
+
+    def get(self):
+        kind, value = self.filled.get()
+        if kind == "error":
+            raise value
+        return kind, value
+
+    def iter_chunks(self):
+        while True:
+            kind, value = self.get()
+            if kind == "sha256":
+                self.sha256 = value
+                return
+            buf, n = value
+            try:
+                yield memoryview(buf)[:n]
+            finally:
+                self.free.put(buf)
+
+    def __iter__(self):
+        """
+        Yield `(filepath, stat, chunks)` of the files where `chunks` yields
+        the data of the file; each chunk is valid until the next one is
+        taken. When the chunks are exhausted `sha256` is the hex digest of
+        the file.
+        """
+        self.thread.start()
+        while True:
+            kind, value = self.get()
+            if kind == "done":
+                return
+            filepath, stat = value
+            self.sha256 = None
+            yield filepath, stat, self.iter_chunks()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.free.put(None)
+            self.thread.join()
+
+
+def get_manifest_path(zip_path):
+    """
+    Return the path of the manifest of a package zip archive.
+    """
+    return os.path.splitext(zip_path)[0] + MANIFEST_SUFFIX
+
+
+def read_manifest(manifest_path):
+    """
+    Return a dict of the archived file paths and their `(size, mtime,
+    sha256)` from a manifest. The size and the modification time (in ns)
+    tell whether a file has changed since it was packaged.
+    """
+    manifest = {}
+    with open(manifest_path, newline="") as _manifest:
+        for row in csv.DictReader(_manifest):
+            manifest[row["file"]] = (int(row["size"]), int(row["mtime"]), row["sha256"])
+    return manifest
+
+
+def check_zip(zip_path, manifest_path):
+    """
+    Check that a zip archive has exactly the files listed in its manifest,
+    with the same sizes. Only the central directory of the archive is read.
+    """
+    files = {k: v[0] for k, v in read_manifest(manifest_path).items()}
+    try:
+        with zipfile.ZipFile(zip_path) as _zip:
+            members = {k.filename: k.file_size for k in _zip.infolist()}
+    except zipfile.BadZipFile as e:
+        raise Exception(f"The zip archive {zip_path} is damaged: {e}")
+    if members != files:
+        raise Exception(f"The zip archive {zip_path} does not match its manifest.")
+
+
+def is_incomplete(base):
+    """
+    Tell whether the build of a package (or of the package of a volume),
+    given by its path without the extension, is unfinished.
+    """
+    return os.path.exists(base + CHECKPOINT_SUFFIX) or os.path.exists(
+        VOLUME_SUFFIX_RE.sub("", base) + CHECKPOINT_SUFFIX
+    )
+
+
+def read_yaml_files(yaml_path):
+    """
+    Return the set of the archived file paths defined in a package YAML
+    file, for the packages built without a manifest.
+    """
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(yaml_path) as _yaml:
+        data = yaml.load(_yaml, Loader=loader) or {}
+    files = set()
+    for collection in data.get("collections") or []:
+        for deployment in collection.get("deployments") or []:
+            for resource in deployment.get("resources") or []:
+                files.add(
+                    "/".join(
+                        [
+                            collection["resources_dir"],
+                            deployment["deployment_id"],
+                            resource["file"],
+                        ]
+                    )
+                )
+    return files
+
+
+def read_packaged_files(paths):
+    """
+    Return the set of the archived file paths ("collection/deployment/file")
+    of previous packages. A path is a file of a package (its YAML, zip or
+    manifest) or a directory, in which case all packages in it are read.
+    The manifest is read if there is one, otherwise the YAML definition.
+    The unfinished packages in a directory are left out.
+    """
+    bases = set()
+    for path in paths:
+        if os.path.isdir(path):
+            bases.update(
+                os.path.splitext(entry.path)[0]
+                for entry in os.scandir(path)
+                if entry.is_file()
+                and entry.name.endswith(".yaml")
+                and not is_incomplete(os.path.splitext(entry.path)[0])
+            )
+        elif path.endswith(MANIFEST_SUFFIX):
+            bases.add(path[: -len(MANIFEST_SUFFIX)])
+        else:
+            bases.add(os.path.splitext(path)[0])
+
+    files = set()
+    for base in sorted(bases):
+        manifest_path = base + MANIFEST_SUFFIX
+        yaml_path = base + ".yaml"
+        if os.path.isfile(manifest_path):
+            files.update(read_manifest(manifest_path))
+        elif os.path.isfile(yaml_path):
+            files.update(read_yaml_files(yaml_path))
+        else:
+            raise Exception(f"There is no package definition: {yaml_path}")
+    return files
+
+
+class ResourceGroup:
+    """
+    The files of a single deployment kept in a compact form: only their
+    names and type codes; the full paths and the definitions are built
+    when they are needed.
+    """
+
+    __slots__ = ("deployment", "path", "names", "file_types", "size")
+    FILE_TYPES = ("image", "video")
+
+    def __init__(self, deployment, path, media_files):
+        self.deployment = deployment
+        self.path = path
+        self.names = [k.name for k in media_files]
+        self.file_types = bytes(self.FILE_TYPES.index(k.file_type) for k in media_files)
+        self.size = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        """
+        Yield `(name, file_type)` of the files.
+        """
+        for name, code in zip(self.names, self.file_types):
+            yield name, self.FILE_TYPES[code]
+
+    def get_size(self):
+        """
+        Return the total size of the files in bytes. It is read only once.
+        """
+        if self.size is None:
+            self.size = sum(
+                os.path.getsize(os.path.join(self.path, name)) for name in self.names
+            )
+        return self.size
+
+
+class ResourceFiles:
+    """
+    The full paths of all files of a package, in the order of the
+    collections, deployments and files. They are joined only when
+    accessed but the object can be used like the list of paths it
+    replaces (`len`, iteration and indexing).
+    """
+
+    __slots__ = ("groups", "length")
+
+    def __init__(self, groups=None):
+        self.groups = []
+        self.length = 0
+        for group in groups or []:
+            self.append(group)
+
+    def append(self, group):
+        self.groups.append(group)
+        self.length += len(group)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for group in self.groups:
+            for name in group.names:
+                yield os.path.join(group.path, name)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("list index out of range")
+        for group in self.groups:
+            if i < len(group):
+                return os.path.join(group.path, group.names[i])
+            i -= len(group)
+
+
 class YAMLDefinitionGenerator:
     """
     TODO: docstrings
     """
 
+    # reading the dates is bound by the I/O latency (e.g. of a NAS) rather
+    # than by the CPU, so it runs in threads
+    DEFAULT_WORKERS = 8
+
     def __init__(
         self,
         data_dir,
@@ -51,6 +500,11 @@ class YAMLDefinitionGenerator:
         video_ext,
         project_name,
         timezone_ignore_dst=False,
+        workers=None,
+        metadata_cache=None,
+        media_index=None,
+        walk_workers=1,
+        exclude=None,
     ):
         self.data_dir = data_dir
         self.collections = collections
@@ -60,8 +514,22 @@ class YAMLDefinitionGenerator:
         self.video_ext = video_ext
         self.all_ext = image_ext + video_ext
         self.project_name = project_name
-        self.files = []
-        self.data_dict = self.build_data_dict()
+        self.workers = max(int(workers or self.DEFAULT_WORKERS), 1)
+        self.metadata_cache = metadata_cache
+        # the archived paths ("collection/deployment/file") which are
+        # already packaged and left out of the definition
+        self.exclude = exclude
+        self.localizer = TimestampLocalizer(timezone, timezone_ignore_dst)
+        if media_index is None:
+            media_index = MediaIndex(
+                data_dir,
+                image_ext,
+                video_ext,
+                include=collections,
+                workers=walk_workers,
+            )
+        self.files = ResourceFiles()
+        self.scan(media_index)
 
     def get_collection_def(self, name):
         collection_def = OrderedDict()
@@ -80,75 +548,216 @@ class YAMLDefinitionGenerator:
         deployment_def["resources"] = []
         return deployment_def
 
-    def get_date_recorded(self, filepath):
+    def get_file_type(self, filepath):
+        ext = os.path.splitext(filepath)[1].lower()
+        if ext in self.image_ext:
+            return "image"
+        if ext in self.video_ext:
+            return "video"
+        return None
+
+    def get_date_recorded(self, filepath, file_type=None):
         """
         The method to get datetime when resource was recorded under
         a simple assumption that this is a date of the last modification of
         recorded file. It returns UTC timestamp. In case of images it first
-        tries to read 'DateTimeOriginal` EXIF tag.
+        tries to read 'DateTimeOriginal` EXIF tag and in case of videos
+        the creation time stored in the MP4/MOV or AVI header.
         """
-        if os.path.splitext(filepath)[1].lower() in self.image_ext:
-            try:
-                dt = Image.open(filepath)._getexif()[36867]
-                dt = datetime.datetime.strptime(dt, "%Y:%m:%d %H:%M:%S")
+        return self.localizer.format_utc(self.get_local_date(filepath, file_type))
 
-            except Exception:
-                dt = datetime.datetime.fromtimestamp(os.path.getmtime(filepath))
-        else:
-            dt = datetime.datetime.fromtimestamp(os.path.getmtime(filepath))
-        # make datetime object timezone aware
-        if self.timezone_ignore_dst:
-            dt = localize_ignore_dst(dt, self.timezone)
+    def get_local_date(self, filepath, file_type=None):
+        """
+        Return the datetime when resource was recorded (see
+        `get_date_recorded`) before it is converted to UTC: a naive local
+        datetime or an aware one (MP4 creation time).
+        """
+        if file_type is None:
+            file_type = self.get_file_type(filepath)
+        stat = os.stat(filepath)
+        if self.metadata_cache is not None:
+            dt = self.metadata_cache.get_date_recorded(filepath, file_type, stat)
         else:
-            dt = self.timezone.localize(dt)
-        # convert to UTC
-        dt = dt.astimezone(pytz.utc)
-        dt = datetime.datetime.strftime(dt, "%Y-%m-%dT%H:%M:%S%z")
+            dt = read_date_recorded(filepath, file_type)
+        if dt is None:
+            dt = datetime.datetime.fromtimestamp(stat.st_mtime)
         return dt
 
-    def get_resource_def(self, resource, resources_level):
+    def get_resource_def(self, resource, resources_level, file_type=None):
+        """
+        Return the definition of a resource with its local recording date;
+        `iter_resource_defs` converts the dates to UTC timestamps in bulk.
+        """
         filepath = os.path.join(resources_level, resource)
         split_name = os.path.splitext(resource)
         resource_def = OrderedDict()
         resource_def["name"] = split_name[0]
         resource_def["file"] = resource
-        resource_def["date_recorded"] = self.get_date_recorded(filepath)
+        resource_def["date_recorded"] = self.get_local_date(filepath, file_type)
         return resource_def
 
-    def filter_files(self, files, src_ext):
-        return [k for k in files if os.path.splitext(k)[1].lower() in [*src_ext]]
+    def run_ordered(self, func, jobs):
+        """
+        Run the jobs in a thread pool, see `utils.run_ordered`.
+        """
+        return run_ordered(func, jobs, self.workers)
+
+    def scan(self, media_index):
+        """
+        Find the deployments and files to package. The slow part (reading
+        the dates of the resources) is done later, while the definitions
+        are built or written.
+        """
+        # a list of (collection, [ResourceGroup])
+        self.deployments = []
+        collections_level = os.path.join(self.data_dir)
+        for collection in self.collections:
+            deployments_level = os.path.join(collections_level, collection)
+            deployments = []
+            for deployment in media_index.get_sub_dirs(collection):
+                media_files = media_index.get_files(collection, deployment)
+                if self.exclude:
+                    prefix = f"{collection}/{deployment}/"
+                    media_files = [
+                        k for k in media_files if prefix + k.name not in self.exclude
+                    ]
+                    if not media_files:
+                        continue
+                group = ResourceGroup(
+                    deployment,
+                    os.path.join(deployments_level, deployment),
+                    media_files,
+                )
+                deployments.append(group)
+
+                # add the files to self.files
+                self.files.append(group)
+
+            if self.exclude and not deployments:
+                # nothing new in the collection
+                continue
+            self.deployments.append((collection, deployments))
+
+        if len(self.files) == 0:
+            if self.exclude:
+                raise Exception(
+                    "There is nothing to package. All files have already been "
+                    "packaged in the previous packages."
+                )
+            raise Exception(
+                (
+                    'There is nothing to package. Better check your "Media root" path '
+                    "and selected image and video extensions."
+                )
+            )
+
+    def get_deployments(self, collection):
+        """
+        Return the names of the deployments of a collection to package.
+        """
+        return [
+            group.deployment
+            for name, groups in self.deployments
+            if name == collection
+            for group in groups
+        ]
+
+    def get_size(self):
+        """
+        Return the total size of the files to package in bytes.
+        """
+        jobs = (
+            (group,) for c, deployments in self.deployments for group in deployments
+        )
+        with closing(self.run_ordered(ResourceGroup.get_size, jobs)) as results:
+            return sum(size for job, size in results)
+
+    def get_volume(self, deployments):
+        """
+        Return a copy of the generator which defines only the given
+        deployments, a list of `(collection, [ResourceGroup])`.
+        """
+        volume = copy.copy(self)
+        volume.deployments = deployments
+        volume.files = ResourceFiles(
+            group for collection, groups in deployments for group in groups
+        )
+        return volume
+
+    def split(self, max_size):
+        """
+        Split the package into volumes (generators made by `get_volume`) of
+        at most `max_size` bytes of the zip archive. The package is cut only
+        between the deployments, so a deployment bigger than `max_size` makes
+        a volume on its own. A collection can span several volumes.
+        """
+        jobs = (
+            (collection, group)
+            for collection, deployments in self.deployments
+            for group in deployments
+        )
+        volumes = []
+        deployments, size = [], 0
+        # the sizes need a stat of each file, so they are read in threads
+        with closing(
+            self.run_ordered(
+                lambda collection, group: (
+                    group.get_size() + len(group) * ZIP_ENTRY_OVERHEAD
+                ),
+                jobs,
+            )
+        ) as results:
+            for (collection, group), group_size in results:
+                if deployments and size + group_size > max_size:
+                    volumes.append(self.get_volume(deployments))
+                    deployments, size = [], 0
+                if not deployments or deployments[-1][0] != collection:
+                    deployments.append((collection, []))
+                deployments[-1][1].append(group)
+                size += group_size
+        if deployments:
+            volumes.append(self.get_volume(deployments))
+        return volumes
+
+    def iter_resource_defs(self):
+        """
+        Yield the definitions of all resources in the order of the
+        collections, deployments and files. The recording dates are read in
+        the thread pool and converted to UTC timestamps in batches.
+        """
+        jobs = (
+            (name, group.path, file_type)
+            for collection, deployments in self.deployments
+            for group in deployments
+            for name, file_type in group
+        )
+        with closing(self.run_ordered(self.get_resource_def, jobs)) as results:
+            while True:
+                resource_objs = [
+                    k for job, k in itertools.islice(results, DATES_BATCH_SIZE)
+                ]
+                if not resource_objs:
+                    break
+                dates = self.localizer.format_utc_many(
+                    [k["date_recorded"] for k in resource_objs]
+                )
+                for resource_obj, date in zip(resource_objs, dates):
+                    resource_obj["date_recorded"] = date
+                    yield resource_obj
 
     def build_data_dict(self):
         data_dict = OrderedDict()
         data_dict["collections"] = []
-        collections_level = os.path.join(self.data_dir)
-        for collection in self.collections:
+        resources = self.iter_resource_defs()
+        for collection, deployments in self.deployments:
             # first create collection object
             collection_obj = self.get_collection_def(
                 name=collection,
             )
-            deployments_level = os.path.join(collections_level, collection)
-            deployments = [
-                k
-                for k in os.listdir(deployments_level)
-                if os.path.isdir(os.path.join(deployments_level, k))
-            ]
-            for deployment in deployments:
-                deployment_obj = self.get_deployment_def(deployment)
-                resources_level = os.path.join(deployments_level, deployment)
-                resources = [
-                    k
-                    for k in os.listdir(resources_level)
-                    if os.path.isfile(os.path.join(resources_level, k))
-                ]
-                resources = self.filter_files(resources, self.all_ext)
-                for resource in resources:
-                    resource_obj = self.get_resource_def(resource, resources_level)
-                    deployment_obj["resources"].append(resource_obj)
-
-                    # add the full path to self.files list
-                    self.files.append(os.path.join(resources_level, resource))
-
+            for group in deployments:
+                deployment_obj = self.get_deployment_def(group.deployment)
+                for i in range(len(group)):
+                    deployment_obj["resources"].append(next(resources))
                 collection_obj["deployments"].append(deployment_obj)
 
             # TODO: remove; now keep it for the compatibility with the yaml schema
@@ -156,18 +765,83 @@ class YAMLDefinitionGenerator:
 
             data_dict["collections"].append(collection_obj)
 
-            if len(self.files) == 0:
-                raise Exception(
-                    (
-                        'There is nothing to package. Better check your "Media root" path '
-                        "and selected image and video extensions."
+        if self.metadata_cache is not None:
+            self.metadata_cache.save()
+        return data_dict
+
+    @property
+    def data_dict(self):
+        # the whole definition in memory; `dump_yaml` does not need it
+        return self.build_data_dict()
+
+    def iter_yaml_events(self):
+        """
+        Yield the YAML events of the definition. Only a single resource is
+        represented at a time, so the memory use does not depend on the
+        size of the package. The output is the same as with `yaml.dump`
+        of `data_dict`.
+        """
+        # only the representer (with `dict_representer`) and the resolver
+        # of the dumper are used, it does not write anything
+        dumper = yaml.Dumper(None, default_flow_style=False)
+
+        def represent(data):
+            node = dumper.represent_data(data)
+            dumper.represented_objects = {}
+            dumper.object_keeper = []
+            return iter_node_events(node, dumper)
+
+        def represent_mapping(data, sequences):
+            # `sequences` are the iterables of the mapping values which
+            # are represented item by item
+            yield yaml.MappingStartEvent(None, _mapping_tag, True, flow_style=False)
+            for key, value in data.items():
+                yield from represent(key)
+                if key not in sequences:
+                    yield from represent(value)
+                    continue
+                yield yaml.SequenceStartEvent(
+                    None, _sequence_tag, True, flow_style=False
+                )
+                for item in sequences[key]:
+                    yield from item
+                yield yaml.SequenceEndEvent()
+            yield yaml.MappingEndEvent()
+
+        def represent_deployments(deployments, resources):
+            for group in deployments:
+                yield represent_mapping(
+                    self.get_deployment_def(group.deployment),
+                    {
+                        "resources": (
+                            represent(next(resources)) for i in range(len(group))
+                        )
+                    },
+                )
+
+        resources = self.iter_resource_defs()
+        yield yaml.StreamStartEvent()
+        yield yaml.DocumentStartEvent()
+        yield from represent_mapping(
+            OrderedDict([("collections", [])]),
+            {
+                "collections": (
+                    represent_mapping(
+                        self.get_collection_def(name=collection),
+                        {"deployments": represent_deployments(deployments, resources)},
                     )
+                    for collection, deployments in self.deployments
                 )
-        return data_dict
+            },
+        )
+        yield yaml.DocumentEndEvent()
+        yield yaml.StreamEndEvent()
 
     def dump_yaml(self, yaml_path):
         with open(yaml_path, "w") as _yaml:
-            yaml.dump(self.data_dict, _yaml)
+            yaml.emit(self.iter_yaml_events(), _yaml, Dumper=YAMLDumper)
+        if self.metadata_cache is not None:
+            self.metadata_cache.save()
 
 
 class DataPackageGenerator:
@@ -188,8 +862,23 @@ class DataPackageGenerator:
         project=None,
         callback=None,
         package_name_prefix="",
+        workers=None,
+        metadata_cache=None,
+        media_index=None,
+        walk_workers=1,
+        volume_size=None,
+        previous_packages=None,
+        resume=False,
     ):
         self.username = username
+        self.workers = workers
+        self.metadata_cache = metadata_cache
+        self.media_index = media_index
+        self.walk_workers = walk_workers
+        self.volume_size = volume_size
+        # in the append mode only the files which are not in the previous
+        # packages (or directories of packages) are packaged
+        self.previous_packages = previous_packages or []
         self.project = project
         self.package_name_prefix = package_name_prefix
         self.callback = callback
@@ -233,8 +922,19 @@ class DataPackageGenerator:
             self.timezone = timezone
         self.timezone_ignore_dst = timezone_ignore_dst
 
+        # continue the last unfinished build (with its file names) if asked to
+        checkpoint = self.find_checkpoint() if resume else None
+        if checkpoint is not None:
+            timestamp = checkpoint["timestamp"]
+            self.completed = checkpoint["completed"]
+        else:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            self.completed = []
+        self.checkpoint_path = os.path.join(
+            self.output_path, self.get_package_name(CHECKPOINT_SUFFIX, timestamp)
+        )
+
         # build file paths
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
         self.log_path = os.path.join(
             self.output_path, self.get_package_name(".log", timestamp)
         )
@@ -244,16 +944,114 @@ class DataPackageGenerator:
         self.zip_path = os.path.join(
             self.output_path, self.get_package_name(".zip", timestamp)
         )
+        self.manifest_path = get_manifest_path(self.zip_path)
 
         self.yaml_generator = self.get_yaml_generator()
+        # the index of the whole tree (an entry per file) is not needed once
+        # the compact resource groups are built
+        self.media_index = None
+        self.volumes = self.get_volumes(timestamp)
+        # the valid members of the partial zip archives are kept, but the
+        # definitions and the archives are made again if the files or the
+        # settings of the definitions have changed since the checkpoint
+        self.digest = self.get_digest()
+        self.resumed = (
+            checkpoint is not None and checkpoint.get("digest") == self.digest
+        )
+        if not self.resumed:
+            self.completed = []
         self.logger = None
 
-    def get_package_name(self, ext, timestamp):
-        pname = self.project + "_" + timestamp + "_" + self.username + ext
+    def get_package_name(self, ext, timestamp, volume=None):
+        pname = self.project + "_" + timestamp + "_" + self.username
+        if volume is not None:
+            pname += f"_vol{volume:03d}"
+        pname += ext
         if self.package_name_prefix:
             pname = self.package_name_prefix + "_" + pname
         return pname.replace(" ", "_")
 
+    def get_checkpoint(self):
+        return {
+            "data_path": self.data_path,
+            "collections": list(self.collections),
+            "previous_packages": list(self.previous_packages),
+            "volume_size": self.volume_size,
+        }
+
+    def get_digest(self):
+        """
+        Return the SHA-256 hex digest of the ordered archive paths of the
+        volumes and of the timezone and extension settings, which the
+        definitions and the archives are made from.
+        """
+        sha256 = hashlib.sha256()
+        settings = [
+            self.timezone.zone,
+            self.timezone_ignore_dst,
+            self.image_ext,
+            self.video_ext,
+        ]
+        sha256.update(json.dumps(settings).encode())
+        for i, volume in enumerate(self.volumes):
+            sha256.update(f"\0volume {i}".encode())
+            for group in volume.yaml_generator.files.groups:
+                prefix = os.path.relpath(group.path, self.data_path).replace("\\", "/")
+                for name in group.names:
+                    path = f"\0{prefix}/{name}"
+                    sha256.update(path.encode("utf-8", "surrogateescape"))
+        return sha256.hexdigest()
+
+    def find_checkpoint(self):
+        """
+        Return the checkpoint of the last unfinished build of the package
+        (with the same media root, collections and options) in the output
+        path or `None`.
+        """
+        prefix, suffix = self.get_package_name(CHECKPOINT_SUFFIX, "\0").split("\0")
+        names = sorted(
+            (
+                k
+                for k in os.listdir(self.output_path)
+                if k.startswith(prefix) and k.endswith(suffix)
+            ),
+            reverse=True,
+        )
+        for name in names:
+            timestamp = name[len(prefix) : -len(suffix)]
+            if len(timestamp) != 14 or not timestamp.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.output_path, name)) as _checkpoint:
+                    checkpoint = json.load(_checkpoint)
+            except (OSError, ValueError):
+                continue
+            if all(checkpoint.get(k) == v for k, v in self.get_checkpoint().items()):
+                checkpoint["timestamp"] = timestamp
+                return checkpoint
+        return None
+
+    def save_checkpoint(self):
+        """
+        Write the checkpoint of the build: its options, the digest of its
+        files and settings and the output files which are already complete.
+        The progress of a zip archive is kept in its manifest.
+        """
+        checkpoint = self.get_checkpoint()
+        checkpoint["digest"] = self.digest
+        checkpoint["completed"] = self.completed
+        tmpfile = self.checkpoint_path + ".tmp"
+        with open(tmpfile, "w") as _checkpoint:
+            json.dump(checkpoint, _checkpoint)
+        os.replace(tmpfile, self.checkpoint_path)
+
+    def set_completed(self, filepath):
+        self.completed.append(os.path.basename(filepath))
+        self.save_checkpoint()
+
+    def is_completed(self, filepath):
+        return os.path.basename(filepath) in self.completed
+
     def get_yaml_generator(self):
         return YAMLDefinitionGenerator(
             data_dir=self.data_path,
@@ -263,19 +1061,249 @@ class DataPackageGenerator:
             timezone=self.timezone,
             timezone_ignore_dst=self.timezone_ignore_dst,
             project_name=self.project,
+            workers=self.workers,
+            metadata_cache=self.metadata_cache,
+            media_index=self.media_index,
+            walk_workers=self.walk_workers,
+            exclude=self.get_packaged_files(),
         )
 
-    def make_zip(self, zip_path, files):
-        self.logger.info(f"Building the zip archive: {zip_path}")
-        with zipfile.ZipFile(zip_path, "w", allowZip64=True) as _zipfile:
-            for i, _file in enumerate(files):
+    def get_packaged_files(self):
+        """
+        Return the set of the files of the previous packages in the append
+        mode or `None`. The delta package defines only the new resources and
+        the deployments which have them, so it is a valid package on its own.
+        """
+        if not self.previous_packages:
+            return None
+        for path in self.previous_packages:
+            if not os.path.exists(path):
+                raise Exception(f"There is no previous package: {path}")
+        return read_packaged_files(self.previous_packages)
+
+    def get_volumes(self, timestamp):
+        """
+        Return the list of `PackageVolume`s to generate: the whole package
+        or, with `volume_size` (in bytes) set, its parts numbered like
+        `..._vol001.yaml` and `..._vol001.zip`. Each volume is a complete
+        package which can be uploaded and processed on its own.
+        """
+        if not self.volume_size:
+            return [
+                PackageVolume(
+                    self.yaml_generator,
+                    self.yaml_path,
+                    self.zip_path,
+                    self.manifest_path,
+                )
+            ]
+        volumes = []
+        for i, yaml_generator in enumerate(
+            self.yaml_generator.split(self.volume_size), 1
+        ):
+            yaml_path = os.path.join(
+                self.output_path, self.get_package_name(".yaml", timestamp, i)
+            )
+            zip_path = os.path.join(
+                self.output_path, self.get_package_name(".zip", timestamp, i)
+            )
+            volumes.append(
+                PackageVolume(
+                    yaml_generator, yaml_path, zip_path, get_manifest_path(zip_path)
+                )
+            )
+        return volumes
+
+    def write_zip_member(self, _zipfile, filepath, arcname, chunks):
+        """
+        Add a file to the zip archive like `ZipFile.write` does, from the
+        chunks of its data, and report the progress in bytes.
+        """
+        zinfo = zipfile.ZipInfo.from_file(filepath, arcname)
+        zinfo.compress_type = _zipfile.compression
+        with _zipfile.open(zinfo, "w") as dest:
+            for chunk in chunks:
+                dest.write(chunk)
+                if self.callback:
+                    self.callback(len(chunk), arcname)
+
+    def read_zip_member(self, _zip, offset, filepath, row):
+        """
+        Return the `ZipInfo` of the member at `offset` of a partial zip
+        archive if it is the complete file `filepath` which is in the
+        manifest `row`, otherwise `None`. The member is validated against
+        its local header and the CRC-32 of its data, and the file must be
+        unchanged since it was added.
+        """
+        arcname = os.path.relpath(filepath, self.data_path).replace("\\", "/")
+        stat = os.stat(filepath)
+        if row != [arcname, str(stat.st_size), str(stat.st_mtime_ns), row[3]]:
+            return None
+        _zip.seek(offset)
+        header = _zip.read(zipfile.sizeFileHeader)
+        if len(header) < zipfile.sizeFileHeader:
+            return None
+        (
+            signature,
+            extract_version,
+            reserved,
+            flag_bits,
+            compress_type,
+            dos_time,
+            dos_date,
+            crc,
+            compress_size,
+            file_size,
+            name_length,
+            extra_length,
+        ) = struct.unpack(zipfile.structFileHeader, header)
+        # the members of a seekable archive have no data descriptors
+        if (
+            signature != zipfile.stringFileHeader
+            or compress_type != zipfile.ZIP_STORED
+            or flag_bits & 0x08
+        ):
+            return None
+        encoding = "utf-8" if flag_bits & 0x800 else "cp437"
+        if _zip.read(name_length).decode(encoding, "replace") != arcname:
+            return None
+        extra = _zip.read(extra_length)
+        while len(extra) >= 4:
+            # the ZIP64 extra field with the sizes of a big file
+            kind, length = struct.unpack("<HH", extra[:4])
+            if kind == 1 and length >= 16:
+                file_size, compress_size = struct.unpack("<QQ", extra[4:20])
+            extra = extra[4 + length :]
+        if file_size != stat.st_size or compress_size != file_size:
+            return None
+
+        crc32, remaining = 0, file_size
+        while remaining:
+            chunk = _zip.read(min(ZIP_CHUNK_SIZE, remaining))
+            if not chunk:
+                return None
+            crc32 = zlib.crc32(chunk, crc32)
+            remaining -= len(chunk)
+        if crc32 != crc:
+            return None
+
+        zinfo = zipfile.ZipInfo.from_file(filepath, arcname)
+        zinfo.date_time = (
+            (dos_date >> 9) + 1980,
+            (dos_date >> 5) & 0xF,
+            dos_date & 0x1F,
+            dos_time >> 11,
+            (dos_time >> 5) & 0x3F,
+            (dos_time & 0x1F) * 2,
+        )
+        zinfo.flag_bits = flag_bits
+        zinfo.CRC = crc
+        zinfo.file_size = zinfo.compress_size = file_size
+        zinfo.header_offset = offset
+        zinfo.extract_version = max(extract_version, zinfo.extract_version)
+        zinfo.create_version = max(extract_version, zinfo.create_version)
+        return zinfo
+
+    def read_zip_members(self, zip_path, files, manifest_path):
+        """
+        Return the `ZipInfo`s of the complete members at the start of the
+        partial zip archive of an interrupted build, the manifest rows of
+        these members and the offset where the next member starts. The
+        validation stops at the first member which is incomplete, changed
+        or missing in the manifest.
+        """
+        members, rows, offset = [], [], 0
+        if not os.path.isfile(zip_path) or not os.path.isfile(manifest_path):
+            return members, rows, offset
+        with open(manifest_path, newline="") as _manifest, open(
+            zip_path, "rb"
+        ) as _zip:
+            reader = csv.reader(_manifest)
+            if next(reader, None) != MANIFEST_FIELDS:
+                return members, rows, offset
+            for filepath, row in zip(files, reader):
+                try:
+                    zinfo = self.read_zip_member(_zip, offset, filepath, row)
+                except (OSError, ValueError, IndexError, struct.error):
+                    zinfo = None
+                if zinfo is None:
+                    break
+                members.append(zinfo)
+                rows.append(row)
+                offset = _zip.tell()
+        return members, rows, offset
+
+    def make_zip(self, zip_path, files, stream=None, manifest_path=None, resume=False):
+        """
+        Build the zip archive at `zip_path` or write it to a writable file
+        object `stream` instead. If the stream is not seekable (e.g. an
+        upload to FTP server) the entries are written with data descriptors.
+        The SHA-256 of the files is written to the `manifest_path` CSV file
+        (if given) along with their size and modification time.
+
+        The files are read ahead in a background thread (`ReadAhead`) while
+        the archive is written. The callback gets the number of bytes added
+        to the archive since its last call and the current file.
+
+        The manifest is flushed after each member, so it is the checkpoint
+        of the archive. With `resume` the valid members of a partial archive
+        at `zip_path` are kept, the rest is truncated and the build goes on
+        from there; the central directory is rebuilt when the archive is
+        closed.
+        """
+        members, rows, offset = [], [], 0
+        if resume and stream is None and manifest_path:
+            members, rows, offset = self.read_zip_members(
+                zip_path, files, manifest_path
+            )
+        with ExitStack() as stack:
+            if members:
+                self.logger.info(
+                    f"Resuming the zip archive: {zip_path} ({len(members)} files)"
+                )
+                _zip = stack.enter_context(open(zip_path, "r+b"))
+                _zip.truncate(offset)
+                _zip.seek(offset)
+                _zipfile = stack.enter_context(
+                    zipfile.ZipFile(_zip, "w", allowZip64=True)
+                )
+                for zinfo in members:
+                    _zipfile.filelist.append(zinfo)
+                    _zipfile.NameToInfo[zinfo.filename] = zinfo
+                if self.callback:
+                    self.callback(
+                        sum(k.file_size for k in members), members[-1].filename
+                    )
+            else:
+                self.logger.info(f"Building the zip archive: {zip_path}")
+                _zipfile = stack.enter_context(
+                    zipfile.ZipFile(stream or zip_path, "w", allowZip64=True)
+                )
+            manifest = None
+            if manifest_path:
+                _manifest = stack.enter_context(open(manifest_path, "w", newline=""))
+                manifest = csv.writer(_manifest)
+                manifest.writerow(MANIFEST_FIELDS)
+                manifest.writerows(rows)
+            reader = stack.enter_context(
+                closing(ReadAhead(itertools.islice(files, len(members), None)))
+            )
+            for _file, stat, chunks in reader:
                 f_archive = os.path.relpath(_file, self.data_path)
                 self.logger.info(f"Adding file: {f_archive}")
-                if self.callback:
-                    self.callback(i, f_archive)
-                _zipfile.write(_file, f_archive)
+                self.write_zip_member(_zipfile, _file, f_archive, chunks)
+                if manifest is not None:
+                    manifest.writerow(
+                        [
+                            f_archive.replace("\\", "/"),
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                            reader.sha256,
+                        ]
+                    )
+                    _manifest.flush()
 
-    def run(self):
+    def set_logger(self):
         # set a data package generator logger
         self.logger = logging.getLogger()
         handler = logging.FileHandler(self.log_path)
@@ -286,12 +1314,95 @@ class DataPackageGenerator:
         self.logger.info(f"Data path: {self.data_path}")
         self.logger.info(f"Output path: {self.output_path}")
         self.logger.info(f'Collections: {", ".join(self.collections)}')
+        if self.previous_packages:
+            self.logger.info(
+                f'Appending to packages: {", ".join(self.previous_packages)}'
+            )
+
+    def run(self):
+        """
+        Generate the package. The progress is checkpointed, so when the
+        build fails or is stopped its outputs are kept and a generator made
+        with `resume` continues it: the complete YAML files are not written
+        again and the zip archives go on from their last complete member.
+        """
+        self.set_logger()
+        if self.resumed:
+            self.logger.info(f"Resuming the build from: {self.checkpoint_path}")
+        self.save_checkpoint()
 
         try:
-            self.yaml_generator.dump_yaml(self.yaml_path)
-            self.make_zip(self.zip_path, self.yaml_generator.files)
+            for volume in self.volumes:
+                if not self.is_completed(volume.yaml_path):
+                    volume.yaml_generator.dump_yaml(volume.yaml_path)
+                    self.set_completed(volume.yaml_path)
+                if not self.is_completed(volume.zip_path):
+                    self.make_zip(
+                        volume.zip_path,
+                        volume.yaml_generator.files,
+                        None,
+                        volume.manifest_path,
+                        resume=self.resumed,
+                    )
+                    self.set_completed(volume.zip_path)
 
         except Exception as e:
-            for _file in [self.log_path, self.yaml_path, self.zip_path]:
-                os.remove(_file)
-                raise e
+            self.logger.error(f"Generating package stopped: {e}")
+            raise
+
+        os.remove(self.checkpoint_path)
+        self.logger.info(f"Generating package finished at {datetime.datetime.now()}")
+
+    def run_upload(self, ftp_client, keep_zip=False, directory="/collections"):
+        """
+        Generate the package and upload it to the FTP server at the same
+        time. The YAML file is uploaded first and then the zip archive is
+        streamed to the server while it is being built, so there is no
+        zip file on the disk unless `keep_zip` is set. The volumes are
+        uploaded one after another.
+        """
+        self.set_logger()
+        self.logger.info(f"Uploading to FTP server: {ftp_client.server}")
+
+        ftp_client.set_ftp_directory(directory)
+        for volume in self.volumes:
+            try:
+                self.upload_volume(ftp_client, volume, keep_zip)
+            except Exception as e:
+                self.logger.error(f"Uploading package stopped: {e}")
+                # the files of the volumes uploaded before are kept
+                for _file in [volume.yaml_path, volume.zip_path, volume.manifest_path]:
+                    if os.path.exists(_file):
+                        os.remove(_file)
+                raise
+        # the streamed package replaces an unfinished local build
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def upload_volume(self, ftp_client, volume, keep_zip=False):
+        """
+        Upload a volume and check the size of each uploaded file on the
+        server against the bytes sent, so a truncated upload fails.
+        """
+        zip_name = os.path.basename(volume.zip_path)
+        volume.yaml_generator.dump_yaml(volume.yaml_path)
+        ftp_client.upload(volume.yaml_path)
+        ftp_client.check_size(
+            os.path.basename(volume.yaml_path), os.path.getsize(volume.yaml_path)
+        )
+        files = volume.yaml_generator.files
+        with ftp_client.open_upload(zip_name) as stream:
+            if keep_zip:
+                with open(volume.zip_path, "wb") as _zip:
+                    self.make_zip(
+                        volume.zip_path, files, Tee(stream, _zip), volume.manifest_path
+                    )
+            else:
+                self.make_zip(zip_name, files, stream, volume.manifest_path)
+        ftp_client.check_size(zip_name, stream.size)
+        # the manifest is complete only when the zip archive is
+        ftp_client.upload(volume.manifest_path)
+        ftp_client.check_size(
+            os.path.basename(volume.manifest_path),
+            os.path.getsize(volume.manifest_path),
+        )
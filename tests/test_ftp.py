@@ -0,0 +1,249 @@
+"""
+Tests of the FTP client and of the package upload against a local FTP
+stand-in: a minimal threaded server (plain FTP, passive mode) which keeps
+the uploaded files in memory.
+"""
+
+import io
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ftp import FTPClient  # noqa: E402
+from package import DataPackageGenerator  # noqa: E402
+
+
+class FTPStandInHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.data_server = None
+        self.rest = 0
+        self.reply("220 FTP stand-in ready")
+        for line in self.rfile:
+            cmd, _, arg = line.decode().strip().partition(" ")
+            cmd = cmd.upper()
+            if cmd == "QUIT":
+                self.reply("221 Bye")
+                return
+            handler = getattr(self, "ftp_" + cmd.lower(), None)
+            if handler is None:
+                self.reply("502 Command not implemented")
+            else:
+                handler(arg)
+
+    def ftp_user(self, arg):
+        self.reply("331 Password required")
+
+    def ftp_pass(self, arg):
+        self.reply("230 Logged in")
+
+    def ftp_type(self, arg):
+        self.reply("200 Type set")
+
+    def ftp_noop(self, arg):
+        self.reply("200 OK")
+
+    def ftp_cwd(self, arg):
+        self.reply("250 OK")
+
+    def ftp_mkd(self, arg):
+        self.reply(f'257 "{arg}" created')
+
+    def ftp_rest(self, arg):
+        self.rest = int(arg)
+        self.reply(f"350 Restarting at {self.rest}")
+
+    def ftp_size(self, arg):
+        files = self.server.files
+        if arg in files:
+            self.reply(f"213 {len(files[arg])}")
+        else:
+            self.reply("550 No such file")
+
+    def ftp_pasv(self, arg):
+        self.data_server = socket.create_server(("127.0.0.1", 0))
+        port = self.data_server.getsockname()[1]
+        self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 255})")
+
+    def ftp_stor(self, arg):
+        self.reply("150 Ready for data")
+        conn, _ = self.data_server.accept()
+        chunks = []
+        with conn:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        self.data_server.close()
+        previous = self.server.files.get(arg, b"")[: self.rest]
+        self.server.files[arg] = previous + b"".join(chunks)
+        self.rest = 0
+        self.reply("226 Transfer complete")
+
+
+class FTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FTPStandInHandler)
+        # file name -> content
+        self.files = {}
+
+
+class FTPStandInTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FTPStandIn()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        host, port = self.server.server_address
+        self.client = FTPClient(f"{host}:{port}", "user", "pass", tls=False)
+        self.assertTrue(self.client.connect())
+        self.client.set_ftp_directory("/collections")
+
+    def tearDown(self):
+        self.client.close_connection()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class FTPClientTest(FTPStandInTestCase):
+    def test_upload_stream(self):
+        data = os.urandom(300000)
+        with self.client.open_upload("package.zip") as stream:
+            for i in range(0, len(data), 8192):
+                stream.write(data[i : i + 8192])
+        self.assertEqual(self.server.files["package.zip"], data)
+        self.assertEqual(self.client.get_size("package.zip"), len(data))
+
+    def test_aborted_upload_stream_keeps_replies_in_sync(self):
+        with self.assertRaises(RuntimeError):
+            with self.client.open_upload("package.zip") as stream:
+                stream.write(b"partial")
+                raise RuntimeError("the zip build failed")
+        # the reply to the aborted transfer must not be taken by the next
+        # commands
+        self.assertEqual(self.client.get_size("package.zip"), len(b"partial"))
+        self.assertEqual(self.client.get_size("other.zip"), None)
+        self.client.ftp.voidcmd("NOOP")
+
+    def test_get_size_of_missing_file(self):
+        self.assertIsNone(self.client.get_size("missing.zip"))
+
+    def test_check_size(self):
+        with self.client.open_upload("package.zip") as stream:
+            stream.write(b"complete")
+        self.client.check_size("package.zip", stream.size)
+        # e.g. a transfer cut short by the server
+        self.server.files["package.zip"] = b"comp"
+        with self.assertRaises(Exception):
+            self.client.check_size("package.zip", stream.size)
+        with self.assertRaises(Exception):
+            self.client.check_size("missing.zip", 0)
+
+    def test_resume_upload(self):
+        data = os.urandom(100000)
+        self.server.files["package.zip"] = data[:30000]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, "package.zip")
+            with open(filepath, "wb") as _file:
+                _file.write(data)
+            rest_pos = self.client.get_size("package.zip")
+            self.client.upload(filepath, rest_pos=rest_pos)
+        self.assertEqual(self.server.files["package.zip"], data)
+
+    def test_copy_has_its_own_connection(self):
+        client = self.client.copy()
+        self.assertFalse(client.connected)
+        self.assertTrue(client.connect())
+        try:
+            with client.open_upload("vol001.zip") as stream:
+                # the original connection is still usable meanwhile
+                self.assertIsNone(self.client.get_size("vol002.zip"))
+                stream.write(b"volume")
+        finally:
+            client.close_connection()
+        self.assertEqual(self.client.get_size("vol001.zip"), len(b"volume"))
+
+
+class PackageUploadTest(FTPStandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.tmpdir, "media")
+        self.output_path = os.path.join(self.tmpdir, "output")
+        os.makedirs(self.output_path)
+        self.files = {}
+        for deployment in ["dep1", "dep2"]:
+            path = os.path.join(self.data_path, "collection", deployment)
+            os.makedirs(path)
+            for i in range(3):
+                data = os.urandom(50000 + i)
+                with open(os.path.join(path, f"IMG_{i:04d}.JPG"), "wb") as _file:
+                    _file.write(data)
+                self.files[f"collection/{deployment}/IMG_{i:04d}.JPG"] = data
+
+    def tearDown(self):
+        super().tearDown()
+        # the generator logs to a file in the output directory
+        logger = logging.getLogger()
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.FileHandler):
+                if handler.baseFilename.startswith(self.tmpdir):
+                    logger.removeHandler(handler)
+                    handler.close()
+        shutil.rmtree(self.tmpdir)
+
+    def get_generator(self):
+        return DataPackageGenerator(
+            self.data_path,
+            self.output_path,
+            ["collection"],
+            "user",
+            "Europe/Warsaw",
+            image_ext=[".jpg"],
+            video_ext=[".mp4"],
+            project="project",
+            workers=2,
+        )
+
+    def test_run_upload_streams_the_zip(self):
+        package_gen = self.get_generator()
+        package_gen.run_upload(self.client)
+        zip_name = os.path.basename(package_gen.zip_path)
+        yaml_name = os.path.basename(package_gen.yaml_path)
+        manifest_name = os.path.basename(package_gen.manifest_path)
+        with zipfile.ZipFile(io.BytesIO(self.server.files[zip_name])) as _zip:
+            self.assertIsNone(_zip.testzip())
+            # the stream is not seekable, so the sizes follow the data
+            for zinfo in _zip.infolist():
+                self.assertTrue(zinfo.flag_bits & 0x08)
+            self.assertEqual({k: _zip.read(k) for k in _zip.namelist()}, self.files)
+        with open(package_gen.yaml_path, "rb") as _yaml:
+            self.assertEqual(self.server.files[yaml_name], _yaml.read())
+        self.assertIn(manifest_name, self.server.files)
+        # there is no zip file on the disk unless it is asked for
+        self.assertFalse(os.path.exists(package_gen.zip_path))
+
+    def test_run_upload_keeps_a_local_zip(self):
+        package_gen = self.get_generator()
+        package_gen.run_upload(self.client, keep_zip=True)
+        zip_name = os.path.basename(package_gen.zip_path)
+        with open(package_gen.zip_path, "rb") as _zip:
+            self.assertEqual(self.server.files[zip_name], _zip.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Small helpers shared by the conversion, the packaging and the GUI.
+"""
+
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SQLiteStore:
+    """
+    An SQLite database with a single table (`SCHEMA`) which can be shared by
+    threads. The writes are committed in batches of `COMMIT_EVERY` rows and
+    by `save()`, the connection is closed by `close()`.
+    """
+
+    SCHEMA = None
+    COMMIT_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.changes = 0
+        # the store is made in the GUI thread and used in the worker ones
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(self.SCHEMA)
+
+    def fetchone(self, query, params):
+        with self.lock:
+            return self.connection.execute(query, params).fetchone()
+
+    def write(self, query, params):
+        with self.lock:
+            self.connection.execute(query, params)
+            self.changes += 1
+            if self.changes >= self.COMMIT_EVERY:
+                self.connection.commit()
+                self.changes = 0
+
+    def save(self):
+        with self.lock:
+            self.connection.commit()
+            self.changes = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+            self.changes = 0
+
+
+def run_ordered(func, jobs, workers):
+    """
+    Run `func(*job)` for each job and yield `(job, result)` pairs in the
+    order of `jobs`. With more than one worker the jobs are executed in
+    a thread pool with a bounded number of jobs in flight. Pending jobs are
+    cancelled as soon as the consumer stops iterating.
+    """
+    if workers == 1:
+        for job in jobs:
+            yield job, func(*job)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for job in jobs:
+                pending.append((job, executor.submit(func, *job)))
+                if len(pending) >= workers * 4:
+                    job, future = pending.popleft()
+                    yield job, future.result()
+            while pending:
+                job, future = pending.popleft()
+                yield job, future.result()
+        finally:
+            for job, future in pending:
+                future.cancel()